@@ -46,6 +46,7 @@ UserAPI.add_urls(app, '/api/v0/user')
 
 RegionStatsAPI.add_urls(app, '/api/v0/report/<report_id>/stats')
 RegionStatsAPI.add_custom_url(app, '/api/v0/stats/polygon', 'polygon', methods=('POST',))
+RegionStatsAPI.add_custom_url(app, '/api/v0/stats/batch', 'batch')
 
 #TODO: this function needs a huge refactor
 @app.route('/api/v0/stats/<table>/<format>/<zone>')
@@ -64,7 +65,6 @@ def stats(table, zone=None, format="csv"):
 
     this_report = ReportType.factory(format)
     this_report.init(zone)
-    this_report.write_header()
 
     logging.info("table id is %s ", table)
     logging.info("and we see %s ", FustionTablesNames.all().filter('table_id =', table).fetch(1))
@@ -77,13 +77,16 @@ def stats(table, zone=None, format="csv"):
             logging.error("report not found")
             abort(404)
 
-        stats = this_report.get_stats(r, table)
+    # stats are read before the report is written so missing ones are
+    # still a 404
+    report_stats = [(r, this_report.get_stats(r, table)) for r in reports]
 
-        for s in stats:
-            this_report.write_row(r, s, table)
+    def rows():
+        for r, stats in report_stats:
+            for s in stats:
+                yield r, s, table
 
-    this_report.write_footer()
-    return this_report.response("report_%s" % table)
+    return this_report.file_response("report_%s" % table, rows())
 
 
 @app.route('/api/v0/stats/polygon/<format>')
@@ -8,6 +8,18 @@ template_folder = os.path.join(os.path.dirname(__file__), '..', 'content', 'temp
 app = Flask('application', template_folder=template_folder)
 app.config.from_object('application.settings')
 
+from application.models import Cell
+
+## Cell parents are written once per request, see Cell.put
+@app.before_request
+def discard_cell_parents():
+    Cell.discard_parents()
+
+@app.after_request
+def flush_cell_parents(response):
+    Cell.flush_parents()
+    return response
+
 ## Error handlers
 # Handle 404 errors
 @app.errorhandler(404)
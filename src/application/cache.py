@@ -0,0 +1,142 @@
+"""
+cache.py
+
+memcache helpers shared by the views and the Earth Engine bridge.
+
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import ee
+import simplejson as json
+from google.appengine.api import memcache
+
+from application import settings
+from application.parallel import fan_out
+
+
+class ByteLRU(object):
+    """ in process LRU cache bounded by the total size of its values """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            # most recently used go last
+            self.items[key] = item
+            return item[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.bytes -= evicted
+
+
+def get_or_compute(key, compute, ttl=3600, wait=0.2, timeout=30):
+    """ return the value cached under key. On a miss only one caller
+        computes it, concurrent callers wait for the value instead of
+        computing it again. None values are not cached
+    """
+    value = memcache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = key + ':lock'
+    deadline = time.time() + timeout
+    while True:
+        if memcache.add(lock_key, 1, time=timeout):
+            try:
+                value = compute()
+                if value is not None:
+                    memcache.set(key, value, time=ttl)
+                return value
+            finally:
+                memcache.delete(lock_key)
+
+        # other request is computing it
+        time.sleep(wait)
+        value = memcache.get(key)
+        if value is not None:
+            return value
+        if time.time() > deadline:
+            logging.warning("timeout waiting for %s, computing it" % key)
+            return compute()
+
+
+def serialized(obj):
+    """ obj.serialize() computed once per ee object, memoized graphs are
+        serialized once for all their uses
+    """
+    s = getattr(obj, '_serialized', None)
+    if s is None:
+        s = obj.serialize()
+        obj._serialized = s
+    return s
+
+
+def expression_key(prefix, image, params=None):
+    """ cache key for an ee object and its parameters """
+    h = hashlib.sha1(serialized(image))
+    h.update(json.dumps(params, sort_keys=True))
+    return prefix + ':' + h.hexdigest()
+
+
+def map_id(image, vis_params=None):
+    """ cached image.getMapId(vis_params). Only mapid and token are cached,
+        same expression and params share map id until the token expires
+    """
+    def compute():
+        # same as image.getMapId but reusing the serialized image
+        request = dict(vis_params or {}, image=serialized(image))
+        mapid = ee.data.getMapId(request)
+        return {'mapid': mapid['mapid'], 'token': mapid['token']}
+
+    key = expression_key('mapid', image, vis_params)
+    cached = get_or_compute(key, compute, settings.MAPID_CACHE_TIME)
+    return dict(cached, image=image)
+
+
+def thumb_ids(image_ids, params):
+    """ ee.data.getThumbId for each image id with the same params (bands,
+        gain, region...). Returns {'thumbid', 'token'} dicts in image_ids
+        order. Cached ones are read with one memcache call and the rest
+        are requested concurrently, None for the ones that failed
+    """
+    params_key = json.dumps(params, sort_keys=True)
+    keys = ['thumb:' + hashlib.sha1(image_id + params_key).hexdigest() for image_id in image_ids]
+    cached = memcache.get_multi(keys)
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+
+    def compute(i):
+        request = dict(params, image=ee.Image(image_ids[i]).serialize(False))
+        thumb = ee.data.getThumbId(request)
+        return {'thumbid': thumb['thumbid'], 'token': thumb['token']}
+
+    computed = {}
+    results = fan_out(compute, missing, settings.THUMB_MAX_WORKERS)
+    for i, (thumb, error) in zip(missing, results):
+        if thumb is not None:
+            computed[keys[i]] = thumb
+    if computed:
+        memcache.set_multi(computed, time=settings.THUMB_CACHE_TIME)
+    cached.update(computed)
+    return [cached.get(key) for key in keys]
@@ -9,13 +9,17 @@ import random
 
 from google.appengine.api import memcache
 from google.appengine.ext import deferred
+from google.appengine.ext import db
 from google.appengine.ext.db import Key
 
 from app import app
 from application import settings
 from application.constants import amazon_bounds
 from application.ee_bridge import Stats
+from application.parallel import fan_out, TokenBucket
 from application.models import Report, Cell, StatsStore, FustionTablesNames, CellGrid, Tile
+from application.models import Area, Note, Baseline, TimeSeries, SPLITS, ZoneStats, AreaSync
+from application.models import ImagePicker, Downscalling, Migration
 from ee_bridge import NDFI
 from flask import render_template, flash, url_for, redirect, abort, request, make_response
 from ft import FT
@@ -150,13 +154,35 @@ def create_tables_tiles():
 
     return r.as_json() 
 
+@app.route('/_ah/cmd/update_tile_covers', methods=('GET',))
+def update_all_tile_covers():
+    """ compute Tile.covers for tiles saved before it existed """
+    deferred.defer(update_tile_covers)
+    return 'updating'
+
+def update_tile_covers(cursor=None):
+    q = Tile.all()
+    if cursor:
+        q.with_cursor(cursor)
+    tiles = q.fetch(200)
+    grids = CellGrid.by_names(set(c for t in tiles for c in t.cells))
+    for t in tiles:
+        t.update_covers(grids)
+    db.put(tiles)
+    logging.info("covers updated for %d tiles" % len(tiles))
+    if len(tiles) == 200:
+        deferred.defer(update_tile_covers, q.cursor())
+    else:
+        Tile.invalidate_snapshot()
+
 
 @app.route('/_ah/cmd/cron/update_cells_ndfi', methods=('GET',))
 def update_cells_ndfi():
     r = Report.current()
-    cell = Cell.get_or_default(r, 0, 0, 0)
-    for c in iter(cell.children()):
-        c.put()
+    cell = Cell.get_or_default(r, 'sad', 0, 0, 0)
+    children = cell.children()
+    Cell.put_many(children)
+    for c in children:
         deferred.defer(ndfi_value_for_cells, str(c.key()), _queue="ndfichangevalue")
     return 'working'
 
@@ -165,7 +191,7 @@ def update_cells_ndfi():
 @app.route('/_ah/cmd/cron/update_cell/<int:z>/<int:x>/<int:y>', methods=('GET',))
 def update_main_cell_ndfi(z, x, y):
     r = Report.current()
-    cell = Cell.get_or_create(r, x, y, z)
+    cell = Cell.get_or_create(r, 'sad', x, y, z)
     deferred.defer(ndfi_value_for_cells, str(cell.key()), _queue="ndfichangevalue")
     return 'working'
 
@@ -186,9 +212,11 @@ def ndfi_value_for_cells(cell_key):
         logging.error("can't get ndfi change value")
         return
     ndfi = data['properties']['ndfiSum']['values']
-    for row in xrange(10):
-        for col in xrange(10):
-            idx = row*10 + col
+    # ndfi_change_value splits the cell in a SPLITS x SPLITS grid
+    children = cell.children()
+    for row in xrange(SPLITS):
+        for col in xrange(SPLITS):
+            idx = row*SPLITS + col
             count = float(ndfi['count'][idx])
             s = float(ndfi['sum'][idx])
             if count > 0.0:
@@ -198,9 +226,10 @@ def ndfi_value_for_cells(cell_key):
             ratio = ratio/10.0 #10 value is experimental
             # asign to cell
             logging.info('cell ndfi (%d, %d): %f' % (row, col, ratio))
-            c = cell.child(row, col)
-            c.ndfi_change_value = ratio
-            c.put()
+            children[idx].ndfi_change_value = ratio
+    Cell.put_many(children)
+    # deferred tasks are not flask requests
+    Cell.flush_parents()
 
     #cell.calculate_ndfi_change_from_childs()
 
@@ -211,9 +240,10 @@ def update_cells_ndfi_dummy():
     r = Report.current()
     if not r:
         return 'create a report first'
-    cell = Cell.get_or_default(r, 0, 0, 0)
-    for c in iter(cell.children()):
-        c.put()
+    cell = Cell.get_or_default(r, 'sad', 0, 0, 0)
+    children = cell.children()
+    Cell.put_many(children)
+    for c in children:
         deferred.defer(ndfi_value_for_cells_dummy, str(c.key()), _queue="ndfichangevalue")
     return 'working DUMMY'
 
@@ -225,13 +255,13 @@ def ndfi_value_for_cells_dummy(cell_key):
     ne = bounds[0]
     sw = bounds[1]
     polygons = [[ sw, (sw[0], ne[1]), ne, (ne[0], sw[1]) ]]
-    for row in xrange(10):
-        for col in xrange(10):
-            c = cell.child(row, col)
-            c.ndfi_change_value = random.random()
-            c.put()
+    children = cell.children()
+    for c in children:
+        c.ndfi_change_value = random.random()
+    Cell.put_many(children)
 
     cell.calculate_ndfi_change_from_childs()
+    Cell.flush_parents()
 
 
 tables = [
@@ -275,27 +305,40 @@ def update_report_stats(report_id):
         'id': report_id,
         'stats': {}
     }
-    for desc, table, name in tables:
-        stats['stats'].update(stats_for(str(r.key().id()), r.assetid, table))
-        # sleep for some time to avoid problems with FT
-        time.sleep(4)
+    bucket = TokenBucket(settings.STATS_CALLS_PER_SECOND, settings.STATS_MAX_WORKERS)
+
+    def table_stats(table):
+        t0 = time.time()
+        s = stats_for(str(r.key().id()), r.assetid, table)
+        logging.info("stats for table %s took %.2fs" % (table, time.time() - t0))
+        return s
+
+    results = fan_out(table_stats, [table for desc, table, name in tables],
+                      settings.STATS_MAX_WORKERS, bucket)
+    for result, error in results:
+        if error:
+            # let the task be retried
+            raise error
+        stats['stats'].update(result)
 
     data = json.dumps(stats)
+    ZoneStats.save_report(report_id, stats['stats'])
     s = StatsStore.get_for_report(report_id)
     if s:
         s.json = data
+        s.rows_saved = True
         s.put()
     else:
-        StatsStore(report_id=report_id, json=data).put()
+        StatsStore(report_id=report_id, json=data, rows_saved=True).put()
     # wait a little bit to allow app store saves the data
     time.sleep(1.0)
     update_total_stats_for_report(report_id)
 
 def update_total_stats_for_report(report_id):
     r = Report.get(Key(report_id))
-    stats = StatsStore.get_for_report(report_id)
+    stats = ZoneStats.table_accum(report_id, tables_map['Legal Amazon'])
     if stats:
-        s = stats.table_accum(tables_map['Legal Amazon'])[0]
+        s = stats[0]
         logging.info("stats for %s" % s)
         if s:
             r.degradation = s['deg']
@@ -311,6 +354,10 @@ def flush_all():
     if request.args.get('stats',''):
         for x in StatsStore.all():
             x.delete()
+        keys = ZoneStats.all(keys_only=True).fetch(500)
+        while keys:
+            db.delete(keys)
+            keys = ZoneStats.all(keys_only=True).fetch(500)
     return "all killed, colonel Trautman"
 
 @app.route('/_ah/cmd/fusion_tables_names')
@@ -336,4 +383,169 @@ def fusion_tables_names():
 
         FustionTablesNames(table_id=str(table), json=json.dumps(dict(data))).put()
 
+    FustionTablesNames.invalidate_names()
+
     return "working"
+
+
+@app.route('/_ah/cmd/repair_counters', methods=('GET',))
+def repair_all_counters():
+    for r in Report.all():
+        deferred.defer(repair_counters, str(r.key()))
+    return 'repairing'
+
+@app.route('/_ah/cmd/repair_counters/<report_id>', methods=('GET',))
+def repair_report_counters(report_id):
+    deferred.defer(repair_counters, report_id)
+    return 'repairing'
+
+def repair_counters(report_id):
+    """ recompute denormalized cell and report counters from the
+        entities they count
+    """
+    r = Report.get(Key(report_id))
+    cells = []
+    for c in Cell.all().filter('report =', r):
+        c.polygon_count = c.count_polygons()
+        c.note_count = c.count_notes()
+        c.children_done = c.count_children_done()
+        cells.append(c)
+        if len(cells) == 100:
+            # db.put does not propagate changes to the parents
+            db.put(cells)
+            cells = []
+    if cells:
+        db.put(cells)
+    r.cells_finished = r.count_cells_finished()
+    r.put()
+    logging.info("counters repaired for report %s" % report_id)
+
+
+@app.route('/_ah/cmd/migrate_cell_keys', methods=('GET',))
+def migrate_all_cell_keys():
+    for r in Report.all():
+        deferred.defer(migrate_cell_keys, str(r.key()))
+    return 'migrating'
+
+def migrate_cell_keys(report_id, cursor=None):
+    """ move cells saved with automatic ids to their key names
+        (see Cell.key_name_for) and point areas, notes, baselines and
+        time series to the new cells, 200 cells per task
+    """
+    r = Report.get(Key(report_id))
+    q = Cell.all().filter('report =', r)
+    if cursor:
+        q.with_cursor(cursor)
+    cells = q.fetch(200)
+    migrated = {}
+    for c in cells:
+        if c.key().name():
+            continue
+        name = Cell.key_name_for(r, c.operation, c.x, c.y, c.z)
+        new = migrated.get(name) or Cell.get_by_key_name(name)
+        if not new:
+            props = dict((p, getattr(c, p)) for p in Cell.properties())
+            new = Cell(key_name=name, **props)
+            db.put(new)
+        migrated[name] = new
+        for model in (Area, Note, Baseline, TimeSeries):
+            refs = model.all().filter('cell =', c).fetch(1000)
+            for x in refs:
+                x.cell = new
+            # db.put skips Area.save so fusion tables are not touched
+            db.put(refs)
+        db.delete(c)
+    logging.info("%d cells migrated for report %s" % (len(migrated), report_id))
+    if len(cells) == 200:
+        deferred.defer(migrate_cell_keys, report_id, q.cursor())
+    else:
+        # duplicated cells were merged so recompute the counters
+        repair_counters(report_id)
+
+
+@app.route('/_ah/cmd/migrate_stats', methods=('GET',))
+def migrate_stats():
+    """ save ZoneStats rows for stats stored only as json """
+    # old entities have no rows_saved value so they can't be filtered
+    for st in StatsStore.all():
+        if not st.rows_saved:
+            deferred.defer(migrate_report_stats, str(st.key()))
+    return 'migrating'
+
+def migrate_report_stats(stats_key):
+    st = StatsStore.get(Key(stats_key))
+    if st and not st.rows_saved:
+        st.save_rows()
+
+
+@app.route('/_ah/cmd/ft_sync', methods=('GET',))
+def ft_sync():
+    """ send pending area changes to fusion tables, also run by cron in
+        case some drain task was lost
+    """
+    deferred.defer(AreaSync.drain, _queue=settings.FT_SYNC_QUEUE)
+    return 'syncing'
+
+@app.route('/_ah/cmd/ft_sync/status', methods=('GET',))
+def ft_sync_status():
+    return json.dumps(AreaSync.backlog())
+
+
+GEOMETRY_FIELDS = {
+    'CellGrid': (CellGrid, 'geo'),
+    'Tile': (Tile, 'geo'),
+    'Area': (Area, 'geo'),
+    'ImagePicker': (ImagePicker, 'location'),
+    'Downscalling': (Downscalling, 'region'),
+}
+
+@app.route('/_ah/cmd/migrate_geometry', methods=('GET',))
+def migrate_geometry():
+    """ rewrite geometries saved with str() as compact json """
+    for kind in GEOMETRY_FIELDS:
+        deferred.defer(migrate_kind_geometry, kind)
+    return 'migrating'
+
+def migrate_kind_geometry(kind, cursor=None):
+    model, field = GEOMETRY_FIELDS[kind]
+    q = model.all()
+    if cursor:
+        q.with_cursor(cursor)
+    entities = q.fetch(200)
+    changed = []
+    for e in entities:
+        value = getattr(e, field)
+        if not value.is_compact():
+            setattr(e, field, value.compact())
+            changed.append(e)
+    # db.put skips Area.save so fusion tables are not touched
+    db.put(changed)
+    logging.info("%d %s geometries migrated" % (len(changed), kind))
+    if len(entities) == 200:
+        deferred.defer(migrate_kind_geometry, kind, q.cursor())
+
+
+@app.route('/_ah/cmd/reindex_image_pickers', methods=('GET',))
+def reindex_image_pickers():
+    """ save modis_only and the ImagePickerScene entities of every image
+        picker
+    """
+    deferred.defer(reindex_image_picker_batch)
+    return 'reindexing'
+
+def reindex_image_picker_batch(cursor=None):
+    q = ImagePicker.all()
+    if cursor:
+        q.with_cursor(cursor)
+    pickers = q.fetch(100)
+    for p in pickers:
+        p.modis_only = p.is_modis_only()
+    db.put(pickers)
+    scenes = 0
+    for p in pickers:
+        scenes += len(p.put_scenes())
+    logging.info("%d image picker scenes saved" % scenes)
+    if len(pickers) == 100:
+        deferred.defer(reindex_image_picker_batch, q.cursor())
+    else:
+        Migration.finish(ImagePicker.REINDEX)
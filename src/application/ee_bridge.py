@@ -13,6 +13,7 @@
 import ast
 import calendar
 import datetime
+import inspect
 
 import ee
 import logging
@@ -20,11 +21,15 @@ import re
 import time
 
 from flask import jsonify
+from google.appengine.api import memcache
 from google.appengine.api import users
 
 from application.models import Area, Report, Baseline, ImagePicker, Downscalling, Tile, \
-    TimeSeries, CellGrid, Cell
+    TimeSeries, CellGrid, Cell, GRAPH_GENERATION_KEY, current_generation
 import settings
+from application.cache import map_id, get_or_compute, thumb_ids
+from application.parallel import fan_out
+from application import landsat_stack
 
 
 # A multiplier to convert square meters to square kilometers.
@@ -145,6 +150,70 @@ class Stats(object):
 
         return stats
 
+    def get_stats_many(self, reports, table_ids):
+        """Computes deforestation area stats for several reports and tables.
+
+        All the reports are stacked as bands of a single image and reduced
+        over the merged tables, so a single reduceRegions call is made.
+
+        Args:
+          reports: A list of reports, each report a tuple of a numeric
+                   report ID (used to filter the rows of the table
+                   specified by settings.FT_TABLE_ID) and a string image ID.
+          table_ids: A list of numeric IDs of Fusion Tables containing the
+              polygons to analyse.
+
+        Returns:
+          A dictionary from report ID to its stats, in the same format
+          returned by get_stats for all the tables.
+        """
+        if not reports or not table_ids:
+            return {}
+
+        area_image = ee.Image.pixelArea()
+        stack = ee.Image().select([])
+        freezes = []
+        for i, (report_id, asset_id) in enumerate(reports):
+            freeze = self._get_historical_freeze(report_id, ee.Image(asset_id))
+            freezes.append(freeze)
+            cls = freeze.select('class')
+            bands = [
+                ('total', cls.gte(0).And(cls.lt(CLASSES_COUNT))),
+                ('def', cls.eq(Stats.DEFORESTATION)),
+                ('deg', cls.eq(Stats.DEGRADATION)),
+            ]
+            for name, mask in bands:
+                stack = stack.addBands(area_image.mask(mask).select(
+                    [0], ['%d-%s' % (i, name)]))
+
+        polygons = None
+        for table_id in table_ids:
+            fc = ee.FeatureCollection(int(table_id)).map(
+                lambda f, table_id=table_id: f.set('stats_table', int(table_id)))
+            polygons = fc if polygons is None else polygons.merge(fc)
+
+        # all the baselines share the PRODES projection
+        proj = freezes[0].projection().getInfo()
+        reducer = ee.Reducer.sum().forEachBand(stack)
+        features = stack.reduceRegions(
+            polygons, reducer, None, proj['crs'], proj['transform']).getInfo()['features']
+
+        result = dict((str(report_id), {}) for report_id, asset_id in reports)
+        for feature in features:
+            properties = feature['properties']
+            name = properties['name']
+            if isinstance(name, float): name = int(name)
+            table_id = int(properties['stats_table'])
+            for i, (report_id, asset_id) in enumerate(reports):
+                result[str(report_id)]['%s_%s' % (table_id, name)] = {
+                    'id': str(name),
+                    'table': table_id,
+                    'total_area': properties.get('%d-total' % i, 0) * METER2_TO_KM2,
+                    'def': properties.get('%d-def' % i, 0) * METER2_TO_KM2,
+                    'deg': properties.get('%d-deg' % i, 0) * METER2_TO_KM2,
+                }
+        return result
+
     @staticmethod
     def _get_historical_freeze(report_id, frozen_image):
         """Paints deforestation onto an image.
@@ -248,7 +317,7 @@ class EELandsat(object):
         image = self.find_map_image(bound)
 
         if image:
-            raw_mapid = _get_raw_mapid(image.getMapId({
+            raw_mapid = _get_raw_mapid(map_id(image, {
                'bands': ','.join(map_image_bands),
                'gain': self.PREVIEW_GAIN
             }))
@@ -309,6 +378,30 @@ class EELandsat(object):
 
         return mosaic
     
+    @staticmethod
+    def find_scene_ids(scenes):
+        """ id of the first image of find_collection_tile(sensor, tile, date)
+            for each (sensor, tile, date) of scenes, None if there is none.
+            Cached ids are read with one memcache call and the rest are
+            resolved with a single Earth Engine request which only returns
+            the first image of each collection
+        """
+        keys = ['scene:%s:%s:%s' % tuple(scene) for scene in scenes]
+        cached = memcache.get_multi(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if missing:
+            firsts = [EELandsat.find_collection_tile(*scenes[i]).limit(1) for i in missing]
+            infos = ee.data.getValue({'json': ee.serializer.toJSON(firsts)})
+            resolved = {}
+            for i, info in zip(missing, infos):
+                features = info.get('features')
+                if features:
+                    resolved[keys[i]] = features[0]['id']
+            if resolved:
+                memcache.set_multi(resolved, time=settings.SCENE_CACHE_TIME)
+            cached.update(resolved)
+        return [cached.get(key) for key in keys]
+
     @staticmethod
     def find_collection_tile(sensor, tile, start_date, end_date=None):
         wrs_path = tile.split('/')[0]
@@ -403,7 +496,7 @@ class EELandsat(object):
         """
         MAP_IMAGE_BANDS = ['B3', 'B2', 'B1']
         PREVIEW_GAIN = 500
-        return _get_raw_mapid(_get_landsat_toa(start, end).mosaic().getMapId({
+        return _get_raw_mapid(map_id(_get_landsat_toa(start, end).mosaic(), {
             'bands': ','.join(MAP_IMAGE_BANDS),
             'gain': PREVIEW_GAIN
         }))
@@ -412,7 +505,7 @@ class EELandsat(object):
         MAP_IMAGE_BANDS = ['B7', 'B5', 'B4']
         PREVIEW_GAIN = ['0.013','0.009','0.013']        
         
-        return _get_raw_mapid(_get_landsat8(start, end).mosaic().getMapId({
+        return _get_raw_mapid(map_id(_get_landsat8(start, end).mosaic(), {
             'bands': ','.join(MAP_IMAGE_BANDS),
             'gain': ','.join(PREVIEW_GAIN)
         }))
@@ -462,12 +555,12 @@ class SMA(object):
 
         if image:
             if EELandsat.from_class(self.name_sensor):
-                return _get_raw_mapid(image.getMapId({
+                return _get_raw_mapid(map_id(image, {
                     'bands': ','.join(EELandsat.get_image_bands(self.name_sensor).get('bands')),
                     'gain': 500
                 }))
             else:
-                return _get_raw_mapid(image.getMapId({
+                return _get_raw_mapid(map_id(image, {
                     'bands': 'gv,soil,npv',
                     'gain': 256,
                     'bias': 0.0,
@@ -494,13 +587,6 @@ class SMA(object):
         return sma_map
 
     def _unmixed_landsat(self, image):
-        ENDMEMBERS = [
-                      [ 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0], #GV
-                      [1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0], #NPV
-                      [1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0], #SOIL
-                      [4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0]  #CLOUD
-                    ]
-
         """periodo = '' #['2001-01-01', '2001-02-01']
         if self.start_time == 1409529600000:
             logging.info("Start: "+str(self.start_time))
@@ -509,7 +595,7 @@ class SMA(object):
             logging.info("End: "+str(self.end_time))
             periodo = ['2011-06-01', '2011-07-01']"""
 
-        unmixed = ee.Image(image).select([0,1,2,3,4,6]).unmix(ENDMEMBERS)
+        unmixed = landsat_stack.unmix(image)
 
         return unmixed
 
@@ -663,6 +749,53 @@ class SMA(object):
         middle_seconds = int((end + start) / 2000)
         return time.gmtime(middle_seconds).tm_year
 
+# Graphs built by NDFI methods decorated with _memoized_graph, shared by
+# all the requests served by this instance.
+_graph_cache = {}
+_graph_cache_generation = [None]
+GRAPH_CACHE_SIZE = 200
+
+
+def _memoized_graph(method):
+    """Memoizes an NDFI method that builds an ee graph for a period.
+
+    Graphs are keyed by method name, period and the other arguments (sensor,
+    long_span). They are kept in the NDFI instance and in the process, so
+    the same graph is not built twice in a request nor between requests.
+    Process graphs are dropped when the ImagePicker or Downscalling data
+    they are built from changes, see models.bump_graph_generation.
+    """
+    def wrapper(self, period, *args, **kwargs):
+        callargs = inspect.getcallargs(method, self, period, *args, **kwargs)
+        del callargs['self']
+        del callargs['period']
+        key = (method.__name__, period['start'], period['end'],
+               tuple(sorted(callargs.items())))
+
+        graphs = self.__dict__.get('_graphs')
+        if graphs is None:
+            # check once per instance if the process graphs are still valid
+            graphs = self._graphs = {}
+            generation = current_generation(GRAPH_GENERATION_KEY)
+            if generation != _graph_cache_generation[0]:
+                _graph_cache.clear()
+                _graph_cache_generation[0] = generation
+
+        if key not in graphs:
+            graph = _graph_cache.get(key)
+            if graph is None:
+                graph = method(self, period, *args, **kwargs)
+                if len(_graph_cache) >= GRAPH_CACHE_SIZE:
+                    _graph_cache.clear()
+                _graph_cache[key] = graph
+            graphs[key] = graph
+        return graphs[key]
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
 class NDFI(object):
     """A helper for computing NDFI status on MODIS image over a time period."""
     MODIS_NAME = 'MODIS'
@@ -709,12 +842,12 @@ class NDFI(object):
         image = self._ndfi_image_rgb(map_image, bounds)
 
         if EELandsat.from_class(map_image):
-            return _get_raw_mapid(image.getMapId({
+            return _get_raw_mapid(map_id(image, {
                  'bands': ','.join(EELandsat.get_image_bands(map_image).get('bands')),
                  'gain': 500
             }))
         else:
-            return _get_raw_mapid(image.getMapId({
+            return _get_raw_mapid(map_id(image, {
                 'bands': 'gv,soil,npv',
                 'gain': 256,
                 'bias': 0.0,
@@ -791,7 +924,7 @@ class NDFI(object):
         """Returns a Map ID for a visualization of the NDFI difference between last_period and work_period."""
         return _get_raw_mapid(
 		    #self._ndfi_change(asset_id, sensor).getMapId({'format': 'png'}))
-            self._ndfi_delta(asset_id, sensor).getMapId({'format': 'png'}))
+            map_id(self._ndfi_delta(asset_id, sensor), {'format': 'png'}))
 
 
     def rgb0id(self):
@@ -819,7 +952,7 @@ class NDFI(object):
         """Returns a Map ID for the given classification asset, masked to only show CLS_BASELINE areas."""
         classification = ee.Image(asset_id).select(0)
         return _get_raw_mapid(
-            classification.mask(classification.eq(CLS_BASELINE)).getMapId())
+            map_id(classification.mask(classification.eq(CLS_BASELINE))))
 
     def freeze_map(self, asset_id, table_id, report_id):
         """Saves a new baseline image as an asset.
@@ -917,7 +1050,7 @@ class NDFI(object):
             maxs.append(max_value)
 
         # Get stretched image.
-        return _get_raw_mapid(display_image.clip(polygon).getMapId({
+        return _get_raw_mapid(map_id(display_image.clip(polygon), {
             'bands': ','.join(RGB_BANDS),
             'min': ','.join(str(i) for i in mins),
             'max': ','.join(str(i) for i in maxs)
@@ -982,29 +1115,25 @@ class NDFI(object):
         diff = self._delta(asset_id).select(0)
         masked = diff.mask(diff.mask().And(diff.lte(MAX_NDFI)))
 
-        # Aggregate each cell.
-        count_reducer = ee.Reducer.count()
-        sum_reducer = ee.Reducer.sum()
-        results = []
-        for y in range(rows):
-            for x in range(cols):
-                # Compose the reduction query for the cell.
-                index = y * cols + x
-                cell_img = masked.mask(masked.mask().And(index_image.eq(index)))
-                count_query = cell_img.reduceRegion(
-                    count_reducer, rect, None, MODIS_CRS, MODIS_TRANSFORM)
-                sum_query = cell_img.reduceRegion(
-                    sum_reducer, rect, None, MODIS_CRS, MODIS_TRANSFORM)
-                # Run the aggregations.
-                count = ee.data.getValue(
-                    {'json': ee.serializer.toJSON(count_query, False)})
-                summed = ee.data.getValue(
-                    {'json': ee.serializer.toJSON(sum_query, False)})
-                results.append([count, summed])
-
-        # Repackages the results in a backward-compatible form:
-        counts = [int(i[0]['ndfi']) for i in results]
-        sums = [int(i[1]['ndfi']) for i in results]
+        # Aggregate all the cells at once: count and sum share the ndfi
+        # input and are grouped by the cell index band.
+        reducer = ee.Reducer.count().combine(
+            reducer2=ee.Reducer.sum(), sharedInputs=True).group(
+            groupField=1, groupName='cell')
+        query = masked.addBands(index_image).reduceRegion(
+            reducer, rect, None, MODIS_CRS, MODIS_TRANSFORM)
+        result = ee.data.getValue(
+            {'json': ee.serializer.toJSON(query, False)})
+
+        # Repackages the results in a backward-compatible form, cells
+        # without valid pixels are not returned in the groups.
+        groups = dict((int(g['cell']), g) for g in result.get('groups', []))
+        counts = []
+        sums = []
+        for index in range(rows * cols):
+            group = groups.get(index, {})
+            counts.append(int(group.get('count', 0)))
+            sums.append(int(group.get('sum', 0)))
         return {
             'properties': {
                 'ndfiSum': {
@@ -1045,7 +1174,7 @@ class NDFI(object):
 
     def _RGB_image_command(self, period, long_span=False):
         """Returns a Map ID for the RGB visualization of a MODIS mosaic for a given period."""
-        return _get_raw_mapid(self._kriged_mosaic(period, long_span).getMapId({
+        return _get_raw_mapid(map_id(self._kriged_mosaic(period, long_span), {
             'bands': 'sur_refl_b01,sur_refl_b04,sur_refl_b03',
             'gain': 0.1,
             'bias': 0.0,
@@ -1054,7 +1183,7 @@ class NDFI(object):
 
     def _SMA_image_command(self, period):
         """Returns a Map ID for the NDFI SMA image for a given period."""
-        return _get_raw_mapid(self._unmixed_mosaic(period).getMapId({
+        return _get_raw_mapid(map_id(self._unmixed_mosaic(period), {
             'bands': 'gv,soil,npv',
             'gain': 256,
             'bias': 0.0,
@@ -1066,20 +1195,20 @@ class NDFI(object):
         
         
         if sensor == 'modis':
-            return _get_raw_mapid(self._NDFI_visualize(period, sensor, long_span).getMapId({
+            return _get_raw_mapid(map_id(self._NDFI_visualize(period, sensor, long_span), {
                 'bands': 'vis-red,vis-green,vis-blue',
                 'gain': 1,
                 'bias': 0.0,
                 'gamma': 1.6
             }))
         elif sensor == 'landsat5': 
-            return _get_raw_mapid(self._NDFI_visualize(period, sensor, long_span).getMapId({
+            return _get_raw_mapid(map_id(self._NDFI_visualize(period, sensor, long_span), {
                 'bands': 'vis-red,vis-green,vis-blue',
                 #'gain': ','.join(['1', '1', '1'])
                 'gain': '1.0, 1.0, 1.0'
             }))
         elif sensor == 'landsat7':
-            return _get_raw_mapid(self._NDFI_visualize(period, sensor, long_span).getMapId({
+            return _get_raw_mapid(map_id(self._NDFI_visualize(period, sensor, long_span), {
                 'bands': 'vis-red,vis-green,vis-blue',
                 'gain': '1.0, 1.0, 1.0'
             }))
@@ -1250,6 +1379,7 @@ class NDFI(object):
 
         return rgb.select([0, 1, 2], ['vis-red', 'vis-green', 'vis-blue'])
 
+    @_memoized_graph
     def _NDFI_image(self, period, sensor='modis',long_span=False):
         """Returns an NDFI mosaic based on MODIS for a given period.
 
@@ -1300,6 +1430,7 @@ class NDFI(object):
 
         return ndfi.select([0], ['ndfi'])
 
+    @_memoized_graph
     def _unmixed_mosaic(self, period, long_span=False):
         """Returns a mosaic with GV, SOIL and NPV indices based on MODIS.
 
@@ -1329,19 +1460,11 @@ class NDFI(object):
         OUTPUTS = ['gv', 'soil', 'npv']
 
         base = self._kriged_mosaic(period, long_span)
-        logging.info(base.getMapId({'bands': 'sur_refl_b01,sur_refl_b02,sur_refl_b03'}))
         unmixed = base.select([BAND_FORMAT % i for i in BANDS]).unmix(ENDMEMBERS)
         result = unmixed.expression('addBands(b(0,1,2), round(max(b(0,1,2), 0) * 100))')
         return result.select(['.*'], OUTPUTS + [i + '_100' for i in OUTPUTS])
 
     def _unmixed_landsat_L5(self, period):
-        ENDMEMBERS = [
-                      [ 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0], #GV
-                      [1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0], #NPV
-                      [1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0], #SOIL
-                      [4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0]  #CLOUD
-                    ]
-
         periodo = '' #['2001-01-01', '2001-02-01']
         if period['start'] == 1409529600000:
             logging.info("Start: "+str(period['start']))
@@ -1357,18 +1480,11 @@ class NDFI(object):
 
         image = collection.mosaic()
 
-        unmixed = ee.Image(image).select([0,1,2,3,4,6]).unmix(ENDMEMBERS)
+        unmixed = landsat_stack.unmix(image)
 
         return unmixed
 
     def _unmixed_landsat_L7(self, period):
-        ENDMEMBERS = [
-                      [ 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0], #GV
-                      [1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0], #NPV
-                      [1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0], #SOIL
-                      [4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0]  # CLOUD
-                    ]
-
         periodo = '' #['2001-01-01', '2001-02-01']
         if period['start'] == 1409529600000:
             logging.info("Start: "+str(period['start']))
@@ -1383,10 +1499,11 @@ class NDFI(object):
 
         image = collection.mosaic()
 
-        unmixed = ee.Image(image).select([0,1,2,3,4,6]).unmix(ENDMEMBERS)
+        unmixed = landsat_stack.unmix(image)
 
         return unmixed
 
+    @_memoized_graph
     def _kriged_mosaic(self, period, long_span=False):
         """Returns an upscaled MODIS mosaic for a given period.
 
@@ -1423,6 +1540,7 @@ class NDFI(object):
         
         return image
 
+    @_memoized_graph
     def _make_mosaic(self, period, long_span=False):
         """Returns a mosaic of MODIS images for a given period.
 
@@ -1627,43 +1745,114 @@ def get_modis_thumbnails_list(year, month, tile, bands='sur_refl_b05,sur_refl_b0
     next_start = datetime.date(int(nextYear), int(nextMonth), 1)
     next_end   = datetime.date(int(nextYear), int(nextMonth), calendar.monthrange(int(nextYear), int(nextMonth))[1])
 
-    collection = ee.ImageCollection('MOD09GA').filterDate(year+'-'+month+'-01', nextYear+'-'+nextMonth+'-01')
-    images = collection.getInfo().get('features')
-    images = images[::-1]
+    def month_images():
+        collection = ee.ImageCollection('MOD09GA').filterDate(year+'-'+month+'-01', nextYear+'-'+nextMonth+'-01')
+        return [image.get('id') for image in collection.getInfo().get('features')]
+    image_ids = get_or_compute('modis_images:%s-%s' % (year, month), month_images, settings.THUMB_CACHE_TIME)
+    image_ids = image_ids[::-1]
 
     MAX_ERROR_METERS = 500.0
     #tile = _get_modis_tile(*cell)
     p = re.compile('\d+')
     p = p.findall(tile)
     logging.info(tile)
-    tile = _get_modis_tile(int(p[0]), int(p[1]))
-    feature = ee.Feature(tile)
-    region = feature.bounds(MAX_ERROR_METERS)
-    reprojected = ee.data.getValue({'json': region.serialize()})['geometry']['coordinates']
-
-    for i in range(len(images)):
-        result = ee.data.getThumbId({
-           'image': ee.Image(images[i].get('id')).serialize(False),
+    def tile_region():
+        feature = ee.Feature(_get_modis_tile(int(p[0]), int(p[1])))
+        region = feature.bounds(MAX_ERROR_METERS)
+        return ee.data.getValue({'json': region.serialize()})['geometry']['coordinates']
+    # tiles don't move, cache the region without expiration
+    reprojected = get_or_compute('modis_region:%s_%s' % (int(p[0]), int(p[1])), tile_region, 0)
+
+    thumbs = thumb_ids(image_ids, {
            'bands': bands,
            'region': reprojected,
            'gain': gain
         })
+    selected_days = ImagePicker.selected_days(start, end, cell)
 
-        imageId = images[i].get('id')
+    for imageId, result in zip(image_ids, thumbs):
+        if result is None:
+            continue
         imageIdSplit = imageId.split('_')
         date = imageIdSplit[4]+'-'+imageIdSplit[3]+'-'+imageIdSplit[2]        
         
-        selected = ImagePicker.is_day_selected(imageIdSplit[2]+'-'+imageIdSplit[3]+'-'+imageIdSplit[4], start, end, cell)
-        
-        if selected:            
-            result_final.append({'thumb': result['thumbid'], 'token': result['token'], 'date': date, 'selected': True})
-        else:            
-            result_final.append({'thumb': result['thumbid'], 'token': result['token'], 'date': date, 'selected': False})
-          
+        selected = (imageIdSplit[2]+'-'+imageIdSplit[3]+'-'+imageIdSplit[4]) in selected_days
+        result_final.append({'thumb': result['thumbid'], 'token': result['token'], 'date': date, 'selected': selected})
+
+    return result_final
+
+def map_ids(layers, required=0):
+    """ map_id for each (image, vis_params) of layers, requested
+        concurrently with up to EE_MAX_WORKERS threads. Returns the map
+        ids in layers order, None for the ones which failed. The error of
+        any of the first ``required`` layers is raised instead
+    """
+    results = fan_out(lambda layer: map_id(*layer), layers, settings.EE_MAX_WORKERS)
+    for result, error in results[:required]:
+        if error:
+            raise error
+    return [result for result, error in results]
+
+def map_layer(feature, type, visibility, description, id=None):
+    """ layer dict for a map id, xyz layers without id use the map id """
+    layer = {'token':       feature['token'],
+             'type':        type,
+             'visibility':  visibility,
+             'description': description,
+             'url': 'https://earthengine.googleapis.com/map/'+feature['mapid']+'/{Z}/{X}/{Y}?token='+feature['token']}
+    if id is None:
+        layer['id'] = feature['mapid']
+    else:
+        layer['mapid'] = feature['mapid']
+        layer['id'] = id
+    return layer
+
+def picked_scene(image_picker):
+    """ (sensor, tile, date) of an image picker entry """
+    day  = str(image_picker['day']).zfill(2)
+    month = str(image_picker['month']).zfill(2)
+    year  = str(image_picker['year'])
+    return image_picker['sensor'], image_picker['cell'], year+'-'+month+'-'+day
+
+def picked_stacks(picks):
+    """ LandsatDataStack of the scene of each image picker entry, scene ids
+        are resolved at once with EELandsat.find_scene_ids
+    """
+    scenes = [picked_scene(p) for p in picks]
+    stacks = []
+    for scene, scene_id in zip(scenes, EELandsat.find_scene_ids(scenes)):
+        if scene_id is None:
+            raise ValueError("no %s image for tile %s on %s" % scene)
+        stacks.append(landsat_stack.get_stack(scene_id))
+    return stacks
+
+def load_picked_images(tile_image_picker, start_date, cell_grid):
+    """ (sensor, RGB map id, LandsatDataStack, shade median) of the image
+        picked for each tile, tiles with none or several images picked are
+        skipped. Earth Engine calls of all the tiles run concurrently
+    """
+    picks = [p[0] for p in tile_image_picker if len(p) == 1]
+    logging.info(picks)
 
+    def load(item):
+        image_picker, landsat_data_stack = item
+        sensor     = image_picker['sensor']
+        tile_name  = image_picker['cell']
+        
+        feature_image = map_id(landsat_data_stack.image, {
+                       'bands': ','.join(EELandsat.get_image_bands(sensor).get('bands')),
+                       'gain': ','.join(EELandsat.get_image_bands(sensor).get('gain'))                          
+                      })
         
+        return sensor, feature_image, landsat_data_stack, shade_median(sensor, str(start_date.year), tile_name)
 
-    return result_final
+    loaded = []
+    for result, error in fan_out(load, zip(picks, picked_stacks(picks)), settings.EE_MAX_WORKERS):
+        # a mosaic without some tile would be saved as the cell result
+        if error:
+            raise error
+        loaded.append(result)
+    return loaded
 
 def create_tile_baseline(start_date, end_date, cell_name):  
     
@@ -1697,61 +1886,24 @@ def create_tile_baseline(start_date, end_date, cell_name):
     logging.info('===== >>>>>>>>> image_picker <<<<<<<<< ========')
     logging.info(tile_image_picker)
     
-    for i in range(len(tile_image_picker)):
-        if len(tile_image_picker[i]) == 1:
-            logging.info(tile_image_picker[i][0])
-            image_picker = tile_image_picker[i][0]
-            sensor     = image_picker['sensor']
-            tile_name  = image_picker['cell']
-        
-            day  = str(image_picker['day']).zfill(2)
-            month = str(image_picker['month']).zfill(2)
-            year  = str(image_picker['year'])
-                
-            date_star  = year+'-'+month+'-'+day
-                
-            collection = EELandsat.find_collection_tile(sensor, tile_name, date_star)
+    for sensor, feature_image, landsat_data_stack, stack_shade_median in load_picked_images(tile_image_picker, start_date, cell_grid):
+        resutls.append(map_layer(feature_image, 'xyz', True, 'RGB/'+sensor))
         
-            #image_num = len(collection.getInfo()['features'])
-                
-            #logging.info(collection.getInfo())
-            image = ee.Image(collection.getInfo()['features'][0]['id'])
-            
-            feature_image = image.getMapId({
-                           'bands': ','.join(EELandsat.get_image_bands(sensor).get('bands')),
-                           'gain': ','.join(EELandsat.get_image_bands(sensor).get('gain'))                          
-                          })
-            
-            resutls.append({'id':          feature_image['mapid'],
-                            'token':       feature_image['token'],
-                            'type':        'xyz',
-                            'visibility':  True,
-                            'description': 'RGB/'+sensor,
-                            'url': 'https://earthengine.googleapis.com/map/'+feature_image['mapid']+'/{Z}/{X}/{Y}?token='+feature_image['token']
-                          })
-            
-            # TODO ajustar os nomes das variaveis
-            landsat_data_stack = get_landsat_data_stack(image, sensor, start_date, None, cell_grid, tile_name)
-            baselines.append(landsat_data_stack['ndfi'])
-            ndfis.append(landsat_data_stack['ndfi_rgb'])
-            smas.append(landsat_data_stack['sma'])
-            
-            gvs.append(landsat_data_stack['gv'])
-            npvs.append(landsat_data_stack['npv'])
-            soils.append(landsat_data_stack['soil'])
-            clouds.append(landsat_data_stack['cloud'])
-            shades.append(landsat_data_stack['shade'])
-            shades_median.append(landsat_data_stack['shade_median'])
-            cloud_regions.append(landsat_data_stack['cloud_region'])
-            temperatures.append(landsat_data_stack['temperature'])
-            
-        elif len(tile_image_picker[i]) > 1 :
-            pass 
-        else:
-            pass 
+        baselines.append(landsat_data_stack.ndfi)
+        ndfis.append(landsat_data_stack.ndfi_rgb)
+        smas.append(landsat_data_stack.sma)
+        
+        gvs.append(landsat_data_stack.gv)
+        npvs.append(landsat_data_stack.npv)
+        soils.append(landsat_data_stack.soil)
+        clouds.append(landsat_data_stack.cloud)
+        shades.append(landsat_data_stack.shade)
+        shades_median.append(stack_shade_median)
+        cloud_regions.append(landsat_data_stack.cloud_region)
+        temperatures.append(landsat_data_stack.temperature)
 
     if len(baselines) > 0:                            
-        geo  = ast.literal_eval(cell_grid.geo)
+        geo  = cell_grid.geo.coordinates
         polygon = ee.Geometry(ee.Geometry.Polygon(geo), "EPSG:4326")
         #polygon = ee.Geometry.Polygon(geo)
         
@@ -1769,8 +1921,20 @@ def create_tile_baseline(start_date, end_date, cell_name):
         
         image_sma = ee.ImageCollection(smas).mosaic().clip(polygon) #TODO: remover e ajustar as dependencias
         
-        feature_baseline = ee.Image(image_baseline).getMapId({
-                              'bands': 'nd'}) #TODO: aqui está o dado ndfi bruto
+        # all the map ids at once, the baseline one is required
+        features = map_ids([
+            (ee.Image(image_baseline), {'bands': 'nd'}), #TODO: aqui está o dado ndfi bruto
+            (ee.Image(image_ndfi), {'bands': 'vis-red,vis-green,vis-blue', 'gain': 1, 'bias': 0.0, 'gamma': 1.6}),
+            (ee.Image(image_sma), {'bands': 'band_2, band_0, band_1', 'gain': '20.0, 3.5, 20.0'}),
+            (ee.Image(image_gv), {'bands': 'band_0'}),
+            (ee.Image(image_shade), {'bands': 'band_0'}),
+            (ee.Image(image_shade_median), {'bands': 'band_0'}),
+            (ee.Image(image_soil), {'bands': 'band_2'}),
+            (ee.Image(image_cloud), {'bands': 'band_3'}),
+            (ee.Image(image_cloud_region), {'bands': 'band_3'}),
+            (ee.Image(image_temperature), {'bands': 'B6'}),
+        ], required=1)
+        feature_baseline = features[0]
         
         mapid = feature_baseline['mapid']
         token = feature_baseline['token']    
@@ -1792,198 +1956,24 @@ def create_tile_baseline(start_date, end_date, cell_name):
         
         resutls.append(baseline_result)
         
-        feature_ndfi = ee.Image(image_ndfi).getMapId({
-                              'bands': 'vis-red,vis-green,vis-blue',
-                              'gain': 1,
-                              'bias': 0.0,
-                              'gamma': 1.6                            
-                              })
-        
-        resutls.append({'id':          feature_ndfi['mapid'],
-                        'token':       feature_ndfi['token'],
-                        'type':        'xyz',
-                        'visibility':  True,
-                        'description': 'NDFI',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_ndfi['mapid']+'/{Z}/{X}/{Y}?token='+feature_ndfi['token']
-                        })
-        
-        feature_sma = ee.Image(image_sma).getMapId({
-                              'bands': 'band_2, band_0, band_1',                              
-                              'gain': '20.0, 3.5, 20.0'                           
-                              })
-        
-        resutls.append({'id':          feature_sma['mapid'],
-                        'token':       feature_sma['token'],
-                        'type':        'xyz',
-                        'visibility':  True,
-                        'description': 'SMA',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_sma['mapid']+'/{Z}/{X}/{Y}?token='+feature_sma['token']
-                        })
-        
-        feature_gv = ee.Image(image_gv).getMapId({
-                              'bands': 'band_0',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_gv['mapid'],
-                        'token':       feature_gv['token'],
-                        'id': 'gv',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'GV band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_gv['mapid']+'/{Z}/{X}/{Y}?token='+feature_gv['token']
-                        })
-        
-        feature_shade = ee.Image(image_shade).getMapId({
-                              'bands': 'band_0',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_shade['mapid'],
-                        'token':       feature_shade['token'],
-                        'id': 'shade',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Shade band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_shade['mapid']+'/{Z}/{X}/{Y}?token='+feature_shade['token']
-                        })
-        
-        feature_shade_median = ee.Image(image_shade_median).getMapId({
-                              'bands': 'band_0',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_shade_median['mapid'],
-                        'token':       feature_shade_median['token'],
-                        'id': 'shade_median',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Shade median band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_shade_median['mapid']+'/{Z}/{X}/{Y}?token='+feature_shade_median['token']
-                        })
-        
-        feature_soil = ee.Image(image_soil).getMapId({
-                              'bands': 'band_2',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_soil['mapid'],
-                        'token':       feature_soil['token'],
-                        'id': 'soil',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Soil band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_soil['mapid']+'/{Z}/{X}/{Y}?token='+feature_soil['token']
-                        })
-        
-        feature_cloud = ee.Image(image_cloud).getMapId({
-                              'bands': 'band_3',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_cloud['mapid'],
-                        'token':       feature_cloud['token'],
-                        'id': 'cloud',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Cloud band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_cloud['mapid']+'/{Z}/{X}/{Y}?token='+feature_cloud['token']
-                        })
-        
-        feature_cloud_region = ee.Image(image_cloud_region).getMapId({
-                              'bands': 'band_3',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_cloud_region['mapid'],
-                        'token':       feature_cloud_region['token'],
-                        'id': 'cloud_region',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Cloud region band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_cloud_region['mapid']+'/{Z}/{X}/{Y}?token='+feature_cloud_region['token']
-                        })
-        
-        feature_temperature = ee.Image(image_temperature).getMapId({
-                              'bands': 'B6',                                                                                      
-                              })
-        
-        resutls.append({'mapid':       feature_temperature['mapid'],
-                        'token':       feature_temperature['token'],
-                        'id': 'temperature',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Temperature band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_temperature['mapid']+'/{Z}/{X}/{Y}?token='+feature_temperature['token']
-                        })
+        layers = [('xyz', True, 'NDFI'),
+                  ('xyz', True, 'SMA'),
+                  ('custom', False, 'GV band', 'gv'),
+                  ('custom', False, 'Shade band', 'shade'),
+                  ('custom', False, 'Shade median band', 'shade_median'),
+                  ('custom', False, 'Soil band', 'soil'),
+                  ('custom', False, 'Cloud band', 'cloud'),
+                  ('custom', False, 'Cloud region band', 'cloud_region'),
+                  ('custom', False, 'Temperature band', 'temperature')]
+        for feature, layer in zip(features[1:], layers):
+            # layers which failed are left out
+            if feature:
+                resutls.append(map_layer(feature, *layer))
         
         return resutls
     else:
         return None
     
-def get_landsat_data_stack(image, sensor, start_date, end_date=None, cell=None, tile_name=None):
-    
-    ENDMEMBERS = [
-                  [ 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0], #GV
-                  [1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0], #NPV
-                  [1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0], #SOIL
-                  [4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0]  # CLOUD
-                 ]
-    
-    ## SMA ===========================================================================
-    unmixed = ee.Image(image).select([0,1,2,3,4,6]).unmix(ENDMEMBERS).max(0) # clamped
-
-    ## NDFI calc =====================================================================
-    summed = unmixed.expression('b(0) + b(1) + b(2) + b(3)')
-    
-    gv    = unmixed.select(0)
-    npv   = unmixed.select(1)
-    soil  = unmixed.select(2)
-    cloud = unmixed.select(3)
-    shade = summed.subtract(1.0).abs()    
-    gv_shade = gv.divide(summed)
-    
-    npv_plus_soil = npv.add(soil)
-    
-    ndfi = ee.Image.cat(gv_shade, npv_plus_soil).normalizedDifference()
-    ndfi = ndfi.multiply(100).add(100).byte()
-    
-    # ndfi_vizualize = ndfi.where(summed.eq(0), INVALID_NDFI) #summed.eq(0) quer dizer e 100% sombra 
-    # ndfi_vizualize = ndfi_vizualize.select([0], ['ndfi']) 
-    
-    ndfi_vizualize = ndfi.select([0], ['ndfi'])
-    
-    red = ndfi_vizualize.interpolate([150, 185], [255, 0], 'clamp')
-    green = ndfi_vizualize.interpolate([  0, 100, 125, 150, 185, 200, 201],
-                                 [255,   0, 255, 165, 140,  80,   0], 'clamp')
-    blue = ndfi_vizualize.interpolate([100, 125], [255, 0], 'clamp')
-
-    rgb = ee.Image.cat(red, green, blue).round().byte()
-
-    ndfi_rgb = rgb.select([0, 1, 2], ['vis-red', 'vis-green', 'vis-blue'])     
-
-    ## Cloud mask ====================================================================
-    cloudThresh = [0.15, 0.07] # % 0-1
-    bufferSize  = 10 #pixels
-    temperatureThresh = 22
-    
-    # Gera a imagem de temperatuira em celsius.
-    temperature = brightness_temperature(image)
-    
-    cloudMask1 = unmixed.select(3).gte(cloudThresh[0]).And(temperature.lte(temperatureThresh))
- 
-    kernel = ee.Kernel.circle(bufferSize, 'pixels')
-
-    buffered = cloudMask1.convolve(kernel)
-    buffered = (buffered.add(cloudMask1)).gt(0)
-
-    return {'ndfi'        : ndfi,
-            'ndfi_rgb'    : ndfi_rgb,
-            'gv'          : gv,
-            'npv'         : npv,
-            'soil'        : soil,
-            'cloud'       : cloud,
-            'shade'       : shade,
-            'shade_median': shade_median(image, sensor, str(start_date.year), tile_name),
-            'cloud_region': buffered,
-            'temperature' : brightness_temperature(image),
-            'sma'         : unmixed.max(0).multiply(100).byte()} #TODO: Remover o sma e ajustar com as variaves gv npv soil cloud
-    
-
 #TODO: Precisamos pensar melhor como tratar essa função quando tivermos varias imagens 
 #TODO: classificadas na série
 
@@ -1991,85 +1981,36 @@ def make_last_map(cell_grid, last_map_info, baseline_image = None):
     
     last_map_class_list = []
     
-    ENDMEMBERS = [
-                  [ 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0], #GV
-                  [1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0], #NPV
-                  [1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0], #SOIL
-                  [4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0]  #CLOUD
-                 ]
-    
     tile_image_picker = last_map_info.image_picker
+    picks = [p[0] for p in tile_image_picker if len(p) == 1]
     
-    for i in range(len(tile_image_picker)):
-        if len(tile_image_picker[i]) == 1:
-            logging.info(tile_image_picker[i][0])
-            image_picker = tile_image_picker[i][0]
-            sensor     = image_picker['sensor']
-            tile_name  = image_picker['cell']
-        
-            day  = str(image_picker['day']).zfill(2)
-            month = str(image_picker['month']).zfill(2)
-            year  = str(image_picker['year'])
-                
-            start_date  = year+'-'+month+'-'+day
-            
-            collection = EELandsat.find_collection_tile(sensor, tile_name, start_date)
-            
-            image = ee.Image(collection.getInfo()['features'][0]['id'])
-    
-            ## SMA ===========================================================================
-            unmixed = ee.Image(image).select([0,1,2,3,4,6]).unmix(ENDMEMBERS).max(0) # clamped
+    for image_picker, stack in zip(picks, picked_stacks(picks)):
+        logging.info(image_picker)
+        sensor     = image_picker['sensor']
+        tile_name  = image_picker['cell']
+        year  = str(image_picker['year'])
         
-            ## NDFI calc =====================================================================
-            #clamped = unmixed.max(0)
-            summed = unmixed.expression('b(0) + b(1) + b(2) + b(3)')
-            
-            gv    = unmixed.select(0)
-            npv   = unmixed.select(1)
-            soil  = unmixed.select(2)
-            cloud = unmixed.select(3)
-            shade = summed.subtract(1.0).abs()    
-            gv_shade = gv.divide(summed)
-            
-            npv_plus_soil = npv.add(soil)
-            
-            ndfi = ee.Image.cat(gv_shade, npv_plus_soil).normalizedDifference()
-            ndfi = ndfi.multiply(100).add(100).byte()
-            
-            ## Valores default para cloud mask ====================================================================
-            cloud_thresh = [0.15] # % 0-1
-            buffer_size  = 10 #pixels
-            temperature_thresh = 22
-            
-            # Gera a imagem de temperatuira em celsius.
-            temperature = brightness_temperature(image)
-            
-            # Cloud mask
-            cloud_mask1 = unmixed.select(3).gte(cloud_thresh[0]).And(temperature.lte(temperature_thresh))
-         
-            kernel = ee.Kernel.circle(buffer_size, 'pixels')
+        image = stack.image
+        ndfi = stack.ndfi
         
-            buffered = cloud_mask1.convolve(kernel)
-            buffered = (buffered.add(cloud_mask1)).gt(0)
+        # Cloud mask
+        cloud_mask = stack.cloud_region.eq(1).And(stack.cloud.gte(last_map_info.cloud))
         
-            cloud_mask = buffered.eq(1).And(unmixed.select([3]).gte(last_map_info.cloud))
-            
-            ## Water mask ====================================================================
-            #_shade_median = shade_median(image, sensor, datetime.datetime.strptime(start_date, "%Y-%b-%d").date(), tile_name)
-            _shade_median = shade_median(image, sensor, year, tile_name)
-            water_mask    = (_shade_median.gte(last_map_info.shade)).And(gv.lte(last_map_info.gv)).And(soil.lte(last_map_info.soil)) 
-            
-            ## Last map classification =================================================================
-            last_map_class = ee.Image(0).mask(image.select(0)) #ndfi.multiply(0)
-            last_map_class = last_map_class.where(ndfi.lt(last_map_info.defo), 3) #Deforestation
-            last_map_class = last_map_class.where(ndfi.gte(last_map_info.defo).And(ndfi.lt(last_map_info.deg)), 2) #Degradation
-            last_map_class = last_map_class.where(ndfi.gte(last_map_info.deg), 1) #Forest
-            last_map_class = last_map_class.where(cloud_mask.eq(1), 5) #Cloud
-            last_map_class = last_map_class.where(water_mask.eq(1), 4) #Water
-            last_map_class_list.append(last_map_class)
+        ## Water mask ====================================================================
+        _shade_median = shade_median(sensor, year, tile_name)
+        water_mask    = (_shade_median.gte(last_map_info.shade)).And(stack.gv.lte(last_map_info.gv)).And(stack.soil.lte(last_map_info.soil)) 
+        
+        ## Last map classification =================================================================
+        last_map_class = ee.Image(0).mask(image.select(0)) #ndfi.multiply(0)
+        last_map_class = last_map_class.where(ndfi.lt(last_map_info.defo), 3) #Deforestation
+        last_map_class = last_map_class.where(ndfi.gte(last_map_info.defo).And(ndfi.lt(last_map_info.deg)), 2) #Degradation
+        last_map_class = last_map_class.where(ndfi.gte(last_map_info.deg), 1) #Forest
+        last_map_class = last_map_class.where(cloud_mask.eq(1), 5) #Cloud
+        last_map_class = last_map_class.where(water_mask.eq(1), 4) #Water
+        last_map_class_list.append(last_map_class)
     
     
-    geo  = ast.literal_eval(cell_grid.geo)
+    geo  = cell_grid.geo.coordinates
     polygon = ee.Geometry(ee.Geometry.Polygon(geo), "EPSG:4326")
         
     last_map_class_mosaic = ee.ImageCollection(last_map_class_list).mosaic().clip(polygon)
@@ -2129,65 +2070,24 @@ def create_tile_timeseries(start_date, end_date, cell_name):
     
     logging.info(tile_image_picker)
     
-    for i in range(len(tile_image_picker)):
-        if len(tile_image_picker[i]) == 1:
-            logging.info(tile_image_picker[i][0])
-            image_picker = tile_image_picker[i][0]
-            sensor     = image_picker['sensor']
-            tile_name  = image_picker['cell']
-        
-            day  = str(image_picker['day']).zfill(2)
-            month = str(image_picker['month']).zfill(2)
-            year  = str(image_picker['year'])
-                
-            date_star  = year+'-'+month+'-'+day
-                
-            collection = EELandsat.find_collection_tile(sensor, tile_name, date_star)
+    for sensor, feature_image, landsat_data_stack, stack_shade_median in load_picked_images(tile_image_picker, start_date, cell_grid):
+        resutls.append(map_layer(feature_image, 'xyz', True, 'RGB/'+sensor))
         
-            #image_num = len(collection.getInfo()['features'])
-                
-            #logging.info(collection.getInfo())
-            image = ee.Image(collection.getInfo()['features'][0]['id'])
-            
-            feature_image = image.getMapId({
-                           'bands': ','.join(EELandsat.get_image_bands(sensor).get('bands')),
-                           'gain': ','.join(EELandsat.get_image_bands(sensor).get('gain'))                          
-                          })
-            
-            resutls.append({'id':          feature_image['mapid'],
-                            'token':       feature_image['token'],
-                            'type':        'xyz',
-                            'visibility':  True,
-                            'description': 'RGB/'+sensor,
-                            'url': 'https://earthengine.googleapis.com/map/'+feature_image['mapid']+'/{Z}/{X}/{Y}?token='+feature_image['token']
-                          })
-            
-            ##
-            landsat_data_stack = get_landsat_data_stack(image, sensor, start_date, None, cell_grid, tile_name)
-            ##
-            
-            ndfis.append(landsat_data_stack['ndfi'])
-            ndfi_rgbs.append(landsat_data_stack['ndfi_rgb'])
-            smas.append(landsat_data_stack['sma'])
-            
-            gvs.append(landsat_data_stack['gv'])
-            npvs.append(landsat_data_stack['npv'])
-            soils.append(landsat_data_stack['soil'])
-            clouds.append(landsat_data_stack['cloud'])
-            shades.append(landsat_data_stack['shade'])
-            shades_median.append(landsat_data_stack['shade_median'])
-            cloud_regions.append(landsat_data_stack['cloud_region'])
-            temperatures.append(landsat_data_stack['temperature'])
-            
-        elif len(tile_image_picker[i]) > 1 :
-            #resutls.append("Process with temporal composition")
-            pass
-        else:
-            pass
-            #resutls.append(None)
+        ndfis.append(landsat_data_stack.ndfi)
+        ndfi_rgbs.append(landsat_data_stack.ndfi_rgb)
+        smas.append(landsat_data_stack.sma)
+        
+        gvs.append(landsat_data_stack.gv)
+        npvs.append(landsat_data_stack.npv)
+        soils.append(landsat_data_stack.soil)
+        clouds.append(landsat_data_stack.cloud)
+        shades.append(landsat_data_stack.shade)
+        shades_median.append(stack_shade_median)
+        cloud_regions.append(landsat_data_stack.cloud_region)
+        temperatures.append(landsat_data_stack.temperature)
     
     if len(ndfis) > 0:                        
-        geo  = ast.literal_eval(cell_grid.geo)
+        geo  = cell_grid.geo.coordinates
         polygon = ee.Geometry(ee.Geometry.Polygon(geo), "EPSG:4326")        
         
         image_ndfi = ee.ImageCollection(ndfis).mosaic().clip(polygon)
@@ -2229,8 +2129,24 @@ def create_tile_timeseries(start_date, end_date, cell_name):
         """
         ==========================================================
         """
-        feature_ndfi = ee.Image(image_ndfi).getMapId({
-                              'bands': 'nd'}) #TODO: aqui está o dado ndfi bruto
+        # all the map ids at once, the time series one is required
+        features = map_ids([
+            (ee.Image(image_ndfi), {'bands': 'nd'}), #TODO: aqui está o dado ndfi bruto
+            (ee.Image(image_ndfi_rgb), {'bands': 'vis-red,vis-green,vis-blue', 'gain': 1, 'bias': 0.0, 'gamma': 1.6}),
+            (ee.Image(image_sma), {'bands': 'band_2, band_0, band_1', 'gain': '20.0, 3.5, 20.0'}),
+            (ee.Image(image_gv), {'bands': 'band_0'}),
+            (ee.Image(image_shade), {'bands': 'band_0'}),
+            (ee.Image(image_shade_median), {'bands': 'band_0'}),
+            (ee.Image(image_soil), {'bands': 'band_2'}),
+            (ee.Image(image_cloud), {'bands': 'band_3'}),
+            (ee.Image(image_cloud_region), {'bands': 'band_3'}),
+            (ee.Image(image_temperature), {'bands': 'B6'}),
+            (ee.Image(image_last_map), {'bands': 'constant', 
+                                        'palette':'ffffff,00994D,00FFFE,000000,0000ff,666666', 
+                                        'min':0,
+                                        'max':5}),
+        ], required=1)
+        feature_ndfi = features[0]
         
         mapid = feature_ndfi['mapid']
         token = feature_ndfi['token']    
@@ -2251,190 +2167,45 @@ def create_tile_timeseries(start_date, end_date, cell_name):
         
         resutls.append(ndfi_result)
         
-        feature_ndfi_rgb = ee.Image(image_ndfi_rgb).getMapId({
-                              'bands': 'vis-red,vis-green,vis-blue',
-                              'gain': 1,
-                              'bias': 0.0,
-                              'gamma': 1.6                            
-                              })
-        
-        resutls.append({'id':          feature_ndfi_rgb['mapid'],
-                        'token':       feature_ndfi_rgb['token'],
-                        'type':        'xyz',
-                        'visibility':  True,
-                        'description': 'NDFI',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_ndfi_rgb['mapid']+'/{Z}/{X}/{Y}?token='+feature_ndfi_rgb['token']
-                        })
-        
-        feature_sma = ee.Image(image_sma).getMapId({
-                              'bands': 'band_2, band_0, band_1',                              
-                              'gain': '20.0, 3.5, 20.0'                           
-                              })
-        
-        resutls.append({'id':          feature_sma['mapid'],
-                        'token':       feature_sma['token'],
-                        'type':        'xyz',
-                        'visibility':  False,
-                        'description': 'SMA',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_sma['mapid']+'/{Z}/{X}/{Y}?token='+feature_sma['token']
-                        })
-        
-        feature_gv = ee.Image(image_gv).getMapId({
-                              'bands': 'band_0',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_gv['mapid'],
-                        'token':       feature_gv['token'],
-                        'id': 'gv',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'GV band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_gv['mapid']+'/{Z}/{X}/{Y}?token='+feature_gv['token']
-                        })
-        
-        feature_shade = ee.Image(image_shade).getMapId({
-                              'bands': 'band_0',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_shade['mapid'],
-                        'token':       feature_shade['token'],
-                        'id': 'shade',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Shade band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_shade['mapid']+'/{Z}/{X}/{Y}?token='+feature_shade['token']
-                        })
-        
-        feature_shade_median = ee.Image(image_shade_median).getMapId({
-                              'bands': 'band_0',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_shade_median['mapid'],
-                        'token':       feature_shade_median['token'],
-                        'id': 'shade_median',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Shade median band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_shade_median['mapid']+'/{Z}/{X}/{Y}?token='+feature_shade_median['token']
-                        })
-        
-        feature_soil = ee.Image(image_soil).getMapId({
-                              'bands': 'band_2',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_soil['mapid'],
-                        'token':       feature_soil['token'],
-                        'id': 'soil',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Soil band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_soil['mapid']+'/{Z}/{X}/{Y}?token='+feature_soil['token']
-                        })
-        
-        feature_cloud = ee.Image(image_cloud).getMapId({
-                              'bands': 'band_3',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_cloud['mapid'],
-                        'token':       feature_cloud['token'],
-                        'id': 'cloud',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Cloud band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_cloud['mapid']+'/{Z}/{X}/{Y}?token='+feature_cloud['token']
-                        })
-        
-        feature_cloud_region = ee.Image(image_cloud_region).getMapId({
-                              'bands': 'band_3',                                                                                      
-                              })
-        
-        resutls.append({'mapid':          feature_cloud_region['mapid'],
-                        'token':       feature_cloud_region['token'],
-                        'id': 'cloud_region',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Cloud region band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_cloud_region['mapid']+'/{Z}/{X}/{Y}?token='+feature_cloud_region['token']
-                        })
-        
-        feature_temperature = ee.Image(image_temperature).getMapId({
-                              'bands': 'B6',                                                                                      
-                              })
-        
-        resutls.append({'mapid':       feature_temperature['mapid'],
-                        'token':       feature_temperature['token'],
-                        'id': 'temperature',
-                        'type':        'custom',
-                        'visibility':  False,
-                        'description': 'Temperature band',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_temperature['mapid']+'/{Z}/{X}/{Y}?token='+feature_temperature['token']
-                        })
-        
-        feature_last_map = ee.Image(image_last_map).getMapId({
-                              'bands': 'constant', 
-                              'palette':'ffffff,00994D,00FFFE,000000,0000ff,666666', 
-                              'min':0,
-                              'max':5                                                                                      
-                              })
-        
-        resutls.append({'mapid':       feature_last_map['mapid'],
-                        'token':       feature_last_map['token'],
-                        'id': 'last_map',
-                        'type':        'xyz',
-                        'visibility':  True,
-                        'description': 'Last Map (#Development#)',
-                        'url': 'https://earthengine.googleapis.com/map/'+feature_last_map['mapid']+'/{Z}/{X}/{Y}?token='+feature_last_map['token']
-                        })
+        layers = [('xyz', True, 'NDFI'),
+                  ('xyz', False, 'SMA'),
+                  ('custom', False, 'GV band', 'gv'),
+                  ('custom', False, 'Shade band', 'shade'),
+                  ('custom', False, 'Shade median band', 'shade_median'),
+                  ('custom', False, 'Soil band', 'soil'),
+                  ('custom', False, 'Cloud band', 'cloud'),
+                  ('custom', False, 'Cloud region band', 'cloud_region'),
+                  ('custom', False, 'Temperature band', 'temperature'),
+                  ('xyz', True, 'Last Map (#Development#)', 'last_map')]
+        for feature, layer in zip(features[1:], layers):
+            # layers which failed are left out
+            if feature:
+                resutls.append(map_layer(feature, *layer))
         return resutls
     else:
         return None
     
-def shade_median(image, sensor, year, tile_name, end_date=None):
-    ENDMEMBERS = [
-                  [ 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0], #GV
-                  [1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0], #NPV
-                  [1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0], #SOIL
-                  [4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0]  # CLOUD
-                 ]
-    
-    image_period_start = year + '-01-01'
-    image_period_end = year + '-12-31'
-    shade_collection = EELandsat.find_collection_tile(sensor, tile_name, image_period_start, image_period_end)
-    logging.info("########### Shade Image ###########")
-    logging.info(len(shade_collection.getInfo().get('features')))  
-    shade_image = shade_collection.filterMetadata('CLOUD_COVER', 'less_than', 100).median()
-    
-    ## SMA shade ===========================================================================
-    shade_unmixed = ee.Image(shade_image).select([0,1,2,3,4,6]).unmix(ENDMEMBERS).max(0) # clamped
-    
-    shade_summed = shade_unmixed.expression('b(0) + b(1) + b(2) + b(3)')
-        
-    return shade_summed.subtract(1.0).abs()
-
-def brightness_temperature(image):
-    
-    image_id = image.getInfo().get('id')
-    collection_name, scene_id = image_id.split('_SR/')
-    
-    image_TOA_id = "LT" + collection_name[1:len(collection_name)] +'_TOA/'+ scene_id
-    logging.info("Image TOA id");
-    logging.info(image_TOA_id);
-    
-    imageTOA = ee.Image(image_TOA_id);
-    
-    #Temperatura em graus celsius
-    temperature = imageTOA.select('B6').subtract(273.15);
-
-    return temperature
+# shade median of (sensor, year, tile), see shade_median
+_shade_medians = {}
+
+def shade_median(sensor, year, tile_name):
+    """ shade of the year median of the tile, built once per process """
+    key = (sensor, year, tile_name)
+    shade = _shade_medians.get(key)
+    if shade is None:
+        image_period_start = year + '-01-01'
+        image_period_end = year + '-12-31'
+        shade_collection = EELandsat.find_collection_tile(sensor, tile_name, image_period_start, image_period_end)
+        shade_image = shade_collection.filterMetadata('CLOUD_COVER', 'less_than', 100).median()
+        
+        ## SMA shade ===========================================================================
+        shade = landsat_stack.shade(landsat_stack.unmix(shade_image).max(0)) # clamped
+        if len(_shade_medians) >= landsat_stack.STACK_CACHE_SIZE:
+            _shade_medians.clear()
+        _shade_medians[key] = shade
+    return shade
 
 def create_baseline(start_date, end_date, sensor=EELandsat.LANDSAT5):
-    ENDMEMBERS = [
-                  [ 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0], #GV
-                  [1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0], #NPV
-                  [1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0], #SOIL
-                  [4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0]  # CLOUD
-                 ]
-
     start_date = datetime.datetime.strptime(start_date,"%d/%b/%Y")
     end_date = datetime.datetime.strptime(end_date,"%d/%b/%Y")
 
@@ -2467,7 +2238,7 @@ def create_baseline(start_date, end_date, sensor=EELandsat.LANDSAT5):
 
     
     ## SMA ===========================================================================
-    unmixed = ee.Image(image).select([0,1,2,3,4,6]).unmix(ENDMEMBERS)
+    unmixed = landsat_stack.unmix(image)
 
     ## NDFI calc =====================================================================
     clamped = unmixed.max(0)
@@ -2499,7 +2270,7 @@ def create_baseline(start_date, end_date, sensor=EELandsat.LANDSAT5):
     classification = classification.where(summed.lte(0.15), 4) #Water
     classification = classification.where(cloudMask2.eq(1), 5) #Cloud
     
-    feature = ee.Image(classification).getMapId({
+    feature = map_id(ee.Image(classification), {
                               'bands': 'nd', 
                               'palette': '000000,00994d,00fffe,000000,0000ff,666666'                            
                               })
@@ -2516,13 +2287,6 @@ def create_baseline(start_date, end_date, sensor=EELandsat.LANDSAT5):
     return baseline.save()
 
 def create_time_series(start_date, end_date, sensor=EELandsat.LANDSAT5):    
-    ENDMEMBERS = [
-                  [ 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0], #GV
-                  [1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0], #NPV
-                  [1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0], #SOIL
-                  [4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0]  # CLOUD
-                 ]
-    
     tiles = Tile.find_tiles_by_sensor('landsat')
 
     start_date = datetime.datetime.strptime(start_date,"%d/%b/%Y")
@@ -2565,7 +2329,7 @@ def create_time_series(start_date, end_date, sensor=EELandsat.LANDSAT5):
         collection = year_image['class_image'].find_full_map_collection()
         image = collection.mosaic() 
         ## SMA ===========================================================================
-        unmixed = ee.Image(image).select([0,1,2,3,4,6]).unmix(ENDMEMBERS)
+        unmixed = landsat_stack.unmix(image)
         
         ## NDFI calc =====================================================================
         clamped = unmixed.max(0)
@@ -2613,7 +2377,7 @@ def create_time_series(start_date, end_date, sensor=EELandsat.LANDSAT5):
     logging.info(years)
     logging.info(colors)
     
-    feature = ee.Image(cumulatedFinal).getMapId({
+    feature = map_id(ee.Image(cumulatedFinal), {
                                                 'bands': 'nd',
                                                 'min': 1,
                                                 'max': len(years),
@@ -2637,9 +2401,7 @@ def get_modis_location(cell):
 
     inclusions = inclusions.filter(inclusions_filter).first()
 
-    location = inclusions.getInfo()['geometry']['coordinates']
-
-    return str(location)
+    return inclusions.getInfo()['geometry']['coordinates']
 
 def get_modis_thumbnail(image_id, cell, bands='sur_refl_b05,sur_refl_b04,sur_refl_b03', gain=[2.0,2.0,2.0]):
     """Returns a thumbnail ID for a given image ID.
@@ -63,6 +63,16 @@ class FT(object):
         r = self.client.query(sql)
         return r
 
+    def sql_batch(self, statements, size=100):
+        """ run statements joined by ';' in requests of up to size
+            statements, return the response of each request.
+            Fusion tables only accepts several INSERT per request
+        """
+        result = []
+        for i in xrange(0, len(statements), size):
+            result.append(self.sql(';'.join(statements[i:i + size])))
+        return result
+
 
 
 
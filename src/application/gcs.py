@@ -0,0 +1,94 @@
+"""
+gcs.py
+
+Files written to Google Cloud Storage a chunk at a time.
+
+Uses a resumable upload of the JSON API with the app service account so
+the content is sent as it is written and never held whole in memory.
+Written files can be served with blobstore.create_gs_key and the
+X-AppEngine-BlobKey header, App Engine reads them from the bucket.
+
+"""
+
+import urllib
+
+from google.appengine.api import app_identity
+from google.appengine.api import urlfetch
+
+import simplejson as json
+
+SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+UPLOAD_URL = 'https://www.googleapis.com/upload/storage/v1/b/%s/o?uploadType=resumable&name=%s'
+# all chunks but the last must be a multiple of 256KB
+CHUNK_SIZE = 4*256*1024
+
+
+class GCSError(Exception):
+    pass
+
+
+class GCSWriter(object):
+    """ file open for writing in bucket, the default app bucket if not
+        given. Call close to finish it, an unfinished upload is dropped
+        by Cloud Storage after a week
+    """
+
+    def __init__(self, name, content_type, bucket=None):
+        self.bucket = bucket or app_identity.get_default_gcs_bucket_name()
+        self.name = name
+        self.offset = 0
+        self.chunks = []
+        self.size = 0
+        result = urlfetch.fetch(UPLOAD_URL % (self.bucket, urllib.quote(name, '')),
+                                method=urlfetch.POST,
+                                payload=json.dumps({'contentType': content_type}),
+                                headers=self._headers({
+                                    'Content-Type': 'application/json',
+                                    'X-Upload-Content-Type': content_type}),
+                                deadline=30)
+        if result.status_code != 200:
+            raise GCSError("can't create %s: %d %s" % (self.gs_path, result.status_code, result.content))
+        self.session = result.headers['Location']
+
+    @property
+    def gs_path(self):
+        """ path for blobstore.create_gs_key """
+        return '/gs/%s/%s' % (self.bucket, self.name)
+
+    def _headers(self, headers):
+        token, expires = app_identity.get_access_token(SCOPE)
+        headers['Authorization'] = 'Bearer ' + token
+        return headers
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= CHUNK_SIZE:
+            data = ''.join(self.chunks)
+            send = len(data) - len(data) % CHUNK_SIZE
+            self._send(data[:send])
+            self.chunks = [data[send:]]
+            self.size = len(self.chunks[0])
+
+    def close(self):
+        self._send(''.join(self.chunks), final=True)
+        self.chunks = []
+        self.size = 0
+
+    def _send(self, data, final=False):
+        total = str(self.offset + len(data)) if final else '*'
+        if data:
+            content_range = 'bytes %d-%d/%s' % (self.offset, self.offset + len(data) - 1, total)
+        else:
+            content_range = 'bytes */%s' % total
+        result = urlfetch.fetch(self.session,
+                                method=urlfetch.PUT,
+                                payload=data,
+                                headers=self._headers({'Content-Range': content_range}),
+                                deadline=60)
+        expected = (200, 201) if final else (308,)
+        if result.status_code not in expected:
+            raise GCSError("upload of %s failed: %d %s" % (self.gs_path, result.status_code, result.content))
+        self.offset += len(data)
@@ -0,0 +1,86 @@
+"""
+geometry.py
+
+Geometry coordinates stored in text properties.
+
+Geometries used to be saved with str() of the coordinate lists and read
+back with ast.literal_eval on every access, which is slow and allocates
+a lot for large tile footprints. GeometryProperty saves them as compact
+json and gives back a Geometry, the text itself with the coordinates
+decoded only the first time they are needed.
+
+"""
+
+import ast
+
+from google.appengine.ext import db
+
+import simplejson as json
+
+
+def dumps(coordinates):
+    """ compact json for a coordinate list """
+    return json.dumps(coordinates, separators=(',', ':'))
+
+
+class Geometry(unicode):
+    """ geometry text which decodes its coordinates once """
+
+    @staticmethod
+    def from_coordinates(coordinates):
+        g = Geometry(dumps(coordinates))
+        g._coordinates = coordinates
+        return g
+
+    @property
+    def coordinates(self):
+        """ decoded coordinates, shared between calls so don't modify them """
+        try:
+            return self._coordinates
+        except AttributeError:
+            try:
+                self._coordinates = json.loads(self)
+            except ValueError:
+                # saved with str(), tuples or unicode prefixes
+                self._coordinates = ast.literal_eval(self)
+            return self._coordinates
+
+    def is_compact(self):
+        """ true if the text is already the compact json encoding """
+        return self == dumps(self.coordinates)
+
+    def compact(self):
+        return Geometry.from_coordinates(self.coordinates)
+
+
+class GeometryProperty(db.TextProperty):
+    """ text property holding a geometry as compact json.
+
+        Accepts coordinate lists or text (json or the old str() format)
+        and returns Geometry values. Text is not parsed until the
+        coordinates are read.
+    """
+
+    data_type = Geometry
+
+    def validate(self, value):
+        if value is not None and not isinstance(value, Geometry):
+            if isinstance(value, (list, tuple)):
+                value = Geometry.from_coordinates(value)
+            elif isinstance(value, basestring):
+                value = Geometry(value)
+            else:
+                raise db.BadValueError('Property %s must be a geometry' % self.name)
+        return super(GeometryProperty, self).validate(value)
+
+    def get_value_for_datastore(self, model_instance):
+        value = super(GeometryProperty, self).get_value_for_datastore(model_instance)
+        if value is not None:
+            # the datastore only knows the exact Text type
+            return db.Text(value)
+        return None
+
+    def make_value_from_datastore(self, value):
+        if value is not None:
+            return Geometry(value)
+        return None
@@ -0,0 +1,95 @@
+"""
+grid.py
+
+Cell grid geometry computed with numpy for a whole zoom level at once.
+
+At level z the top level bounds are split in splits**z columns and rows
+of the same size in mercator space (see Mercator), so the grid is
+defined by its column and row edges. Edges are cached per
+(top_bounds, z, splits).
+
+"""
+
+import math
+
+import numpy as np
+
+_edges = {}
+
+
+def _lat2y(lat):
+    return 180.0/math.pi * np.log(np.tan(math.pi/4.0 + lat*(math.pi/180.0)/2.0))
+
+def _y2lat(y):
+    return 180.0/math.pi * (2.0 * np.arctan(np.exp(y*math.pi/180.0)) - math.pi/2.0)
+
+
+def edges(top_bounds, z, splits):
+    """ return (lats, lons) arrays with the splits**z + 1 row edges from
+        north to south and column edges from west to east.
+        ``top_bounds`` is a tuple with (ne, sw) being ne and sw a
+        (lat, lon) tuple
+    """
+    key = (top_bounds, z, splits)
+    if key not in _edges:
+        (ne_lat, ne_lon), (sw_lat, sw_lon) = top_bounds
+        n = splits**z
+        ys = np.linspace(_lat2y(ne_lat), _lat2y(sw_lat), n + 1)
+        lats = _y2lat(ys)
+        lons = np.linspace(sw_lon, ne_lon, n + 1)
+        lats.setflags(write=False)
+        lons.setflags(write=False)
+        _edges[key] = (lats, lons)
+    return _edges[key]
+
+
+def cell_bounds(top_bounds, z, x, y, splits):
+    """ bounds of cell (x, y) at level z in the same format as top_bounds """
+    lats, lons = edges(top_bounds, z, splits)
+    return (
+        (float(lats[y]), float(lons[x + 1])),
+        (float(lats[y + 1]), float(lons[x]))
+    )
+
+
+def grid_bounds(top_bounds, z, splits):
+    """ bounds of all the cells at level z, an array with shape
+        (n, n, 2, 2) indexed by [x, y] where each item is ((ne_lat, ne_lon),
+        (sw_lat, sw_lon)) as cell_bounds returns
+    """
+    lats, lons = edges(top_bounds, z, splits)
+    n = len(lons) - 1
+    b = np.empty((n, n, 2, 2))
+    b[:, :, 0, 0] = lats[np.newaxis, :-1]
+    b[:, :, 0, 1] = lons[1:, np.newaxis]
+    b[:, :, 1, 0] = lats[np.newaxis, 1:]
+    b[:, :, 1, 1] = lons[:-1, np.newaxis]
+    return b
+
+
+def cells_at(top_bounds, z, lats, lons, splits):
+    """ (x, y) arrays with the cells at level z containing each point,
+        -1 for points outside top_bounds
+    """
+    (ne_lat, ne_lon), (sw_lat, sw_lon) = top_bounds
+    n = splits**z
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    top = _lat2y(ne_lat)
+    bottom = _lat2y(sw_lat)
+    x = np.floor((lons - sw_lon)/(ne_lon - sw_lon)*n).astype(int)
+    y = np.floor((top - _lat2y(lats))/(top - bottom)*n).astype(int)
+    outside = (x < 0) | (x >= n) | (y < 0) | (y >= n)
+    x[outside] = -1
+    y[outside] = -1
+    return x, y
+
+
+def cell_at(top_bounds, z, lat, lon, splits):
+    """ (x, y) of the cell at level z containing the point, None if it
+        is outside top_bounds. Inverse of cell_bounds
+    """
+    x, y = cells_at(top_bounds, z, [lat], [lon], splits)
+    if x[0] < 0:
+        return None
+    return int(x[0]), int(y[0])
@@ -1,23 +1,66 @@
+"""
+kml.py
 
+KML geometry encoding. Paths are a list of rings, each ring a list of
+(lat, lon) points, the first ring being the outer boundary and the
+others the holes.
 
-def path_to_kml(paths):
-    kml = "<Polygon>"
-    kml+= "<outerBoundaryIs>"
-    kml+= "<LinearRing>"
-    kml+="<coordinates>"
-    for p in paths[0]:
-        kml+= str(p[1]) + "," + str(p[0]) + ",0\n"
-    kml += "</coordinates>"
-    kml+= "</LinearRing>"
-    kml+= "</outerBoundaryIs>"
+"""
+
+import re
+
+
+def _coordinates(ring, precision):
+    if precision is None:
+        return "".join("%s,%s,0\n" % (p[1], p[0]) for p in ring)
+    fmt = "%%.%df,%%.%df,0\n" % (precision, precision)
+    return "".join(fmt % (p[1], p[0]) for p in ring)
+
+def _polygon(parts, paths, precision):
+    parts.append("<Polygon><outerBoundaryIs><LinearRing><coordinates>")
+    parts.append(_coordinates(paths[0], precision))
+    parts.append("</coordinates></LinearRing></outerBoundaryIs>")
     for inner in paths[1:]:
-        kml +="<innerBoundaryIs>"
-        kml+= "<LinearRing>"
-        kml+="<coordinates>"
-        for p in inner:
-            kml+= str(p[1]) + "," + str(p[0]) + ",0\n"
-        kml += "</coordinates>"
-        kml+= "</LinearRing>"
-        kml +="</innerBoundaryIs>"
-    kml += "</Polygon>"
-    return kml;
+        parts.append("<innerBoundaryIs><LinearRing><coordinates>")
+        parts.append(_coordinates(inner, precision))
+        parts.append("</coordinates></LinearRing></innerBoundaryIs>")
+    parts.append("</Polygon>")
+
+def path_to_kml(paths, precision=None):
+    """ KML Polygon for paths. If precision is given coordinates are
+        rounded to that number of decimals
+    """
+    parts = []
+    _polygon(parts, paths, precision)
+    return "".join(parts)
+
+def multipolygon_to_kml(polygons, precision=None):
+    """ KML for a list of paths, a MultiGeometry if there are more than one """
+    if len(polygons) == 1:
+        return path_to_kml(polygons[0], precision)
+    parts = ["<MultiGeometry>"]
+    for paths in polygons:
+        _polygon(parts, paths, precision)
+    parts.append("</MultiGeometry>")
+    return "".join(parts)
+
+
+_POLYGON = re.compile(r'<Polygon>(.*?)</Polygon>', re.S)
+_RING = re.compile(r'<(?:outer|inner)BoundaryIs>\s*<LinearRing>\s*'
+                   r'<coordinates>(.*?)</coordinates>', re.S)
+
+def kml_to_paths(kml):
+    """ inverse of multipolygon_to_kml, return a list of paths, one for
+        each Polygon in kml
+    """
+    polygons = []
+    for polygon in _POLYGON.findall(kml):
+        paths = []
+        for coordinates in _RING.findall(polygon):
+            ring = []
+            for point in coordinates.split():
+                lon, lat = point.split(',')[:2]
+                ring.append([float(lat), float(lon)])
+            paths.append(ring)
+        polygons.append(paths)
+    return polygons
@@ -0,0 +1,150 @@
+"""
+landsat_stack.py
+
+Spectral mixture analysis (SMA), NDFI, cloud mask and temperature of a
+Landsat surface reflectance scene.
+
+The ee graph of each product is built once per scene and endmembers and
+only when it is used. Stacks are kept in the process so the baseline,
+time series and last map of a cell share the graphs of the same scenes.
+
+"""
+
+import ee
+
+# GV, NPV, SOIL and CLOUD reflectances for the SMA_BANDS
+ENDMEMBERS = (
+    ( 119.0,  475.0,  169.0, 6250.0, 2399.0,  675.0), #GV
+    (1514.0, 1597.0, 1421.0, 3053.0, 7707.0, 1975.0), #NPV
+    (1799.0, 2479.0, 3158.0, 5437.0, 7707.0, 6646.0), #SOIL
+    (4031.0, 8714.0, 7900.0, 8989.0, 7002.0, 6607.0), #CLOUD
+)
+SMA_BANDS = [0, 1, 2, 3, 4, 6]
+
+# default cloud mask values
+CLOUD_THRESH = 0.15 # % 0-1
+CLOUD_BUFFER_SIZE = 10 # pixels
+CLOUD_TEMPERATURE_THRESH = 22 # celsius
+
+STACK_CACHE_SIZE = 200
+_stacks = {}
+
+
+def unmix(image, endmembers=ENDMEMBERS):
+    """ SMA fractions of image, not clamped """
+    return ee.Image(image).select(SMA_BANDS).unmix([list(e) for e in endmembers])
+
+def summed_fractions(unmixed):
+    return unmixed.expression('b(0) + b(1) + b(2) + b(3)')
+
+def shade(unmixed):
+    return summed_fractions(unmixed).subtract(1.0).abs()
+
+def toa_image_id(image_id):
+    """ top of atmosphere scene of a surface reflectance one """
+    collection_name, scene_id = image_id.split('_SR/')
+    return "LT" + collection_name[1:len(collection_name)] + '_TOA/' + scene_id
+
+
+def get_stack(image_id, endmembers=ENDMEMBERS):
+    """ LandsatDataStack for the scene, shared by the process """
+    endmembers = tuple(tuple(e) for e in endmembers)
+    key = (image_id, endmembers)
+    stack = _stacks.get(key)
+    if stack is None:
+        if len(_stacks) >= STACK_CACHE_SIZE:
+            _stacks.clear()
+        stack = _stacks[key] = LandsatDataStack(image_id, endmembers)
+    return stack
+
+
+class lazy(object):
+    """ property computed on first access and kept in the instance """
+
+    def __init__(self, method):
+        self.method = method
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.method.__name__] = self.method(instance)
+        return value
+
+
+class LandsatDataStack(object):
+    """ products of a Landsat SR scene, use get_stack to build it """
+
+    def __init__(self, image_id, endmembers=ENDMEMBERS):
+        self.image_id = image_id
+        self.endmembers = endmembers
+
+    @lazy
+    def image(self):
+        return ee.Image(self.image_id)
+
+    @lazy
+    def unmixed(self):
+        """ SMA fractions clamped to 0 """
+        return unmix(self.image, self.endmembers).max(0)
+
+    @lazy
+    def summed(self):
+        return summed_fractions(self.unmixed)
+
+    @lazy
+    def gv(self):
+        return self.unmixed.select(0)
+
+    @lazy
+    def npv(self):
+        return self.unmixed.select(1)
+
+    @lazy
+    def soil(self):
+        return self.unmixed.select(2)
+
+    @lazy
+    def cloud(self):
+        return self.unmixed.select(3)
+
+    @lazy
+    def shade(self):
+        return self.summed.subtract(1.0).abs()
+
+    @lazy
+    def ndfi(self):
+        gv_shade = self.gv.divide(self.summed)
+        npv_plus_soil = self.npv.add(self.soil)
+        ndfi = ee.Image.cat(gv_shade, npv_plus_soil).normalizedDifference()
+        return ndfi.multiply(100).add(100).byte()
+
+    @lazy
+    def ndfi_rgb(self):
+        ndfi_vizualize = self.ndfi.select([0], ['ndfi'])
+
+        red = ndfi_vizualize.interpolate([150, 185], [255, 0], 'clamp')
+        green = ndfi_vizualize.interpolate([  0, 100, 125, 150, 185, 200, 201],
+                                     [255,   0, 255, 165, 140,  80,   0], 'clamp')
+        blue = ndfi_vizualize.interpolate([100, 125], [255, 0], 'clamp')
+
+        rgb = ee.Image.cat(red, green, blue).round().byte()
+        return rgb.select([0, 1, 2], ['vis-red', 'vis-green', 'vis-blue'])
+
+    @lazy
+    def sma(self):
+        #TODO: Remover o sma e ajustar com as variaves gv npv soil cloud
+        return self.unmixed.multiply(100).byte()
+
+    @lazy
+    def temperature(self):
+        """ brightness temperature in celsius, from the TOA scene """
+        return ee.Image(toa_image_id(self.image_id)).select('B6').subtract(273.15)
+
+    @lazy
+    def cloud_region(self):
+        """ clouds buffered by CLOUD_BUFFER_SIZE pixels """
+        mask = self.cloud.gte(CLOUD_THRESH).And(self.temperature.lte(CLOUD_TEMPERATURE_THRESH))
+        kernel = ee.Kernel.circle(CLOUD_BUFFER_SIZE, 'pixels')
+        buffered = mask.convolve(kernel)
+        return (buffered.add(mask)).gt(0)
@@ -11,8 +11,12 @@ import calendar
 import re
 import logging
 import operator
+import time as _time
 import types
+import uuid
 
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext import deferred
@@ -21,7 +25,9 @@ from application import settings
 import ee
 from ft import FT
 from kml import path_to_kml
-from mercator import Mercator
+from geometry import GeometryProperty
+import grid
+import spatial
 import simplejson as json
 from time_utils import timestamp
 
@@ -30,6 +36,50 @@ CELL_BLACK_LIST = ['1_4_0', '1_0_4', '1_1_4', '1_4_4']
 
 METER2_TO_KM2 = 1.0/(1000*1000)
 
+# process caches are checked against a token kept in memcache and
+# dropped when it changes. Tokens are never reused so an evicted key
+# can't bring back a value an instance has already seen
+def current_generation(key):
+    """ token of the generation key, a new one if there is none """
+    token = memcache.get(key)
+    if token is None:
+        token = uuid.uuid4().hex
+        if not memcache.add(key, token):
+            token = memcache.get(key) or token
+    return token
+
+def new_generation(key):
+    """ make every instance drop the caches checked against key """
+    memcache.set(key, uuid.uuid4().hex)
+
+# generation changed when the data NDFI mosaics are built from changes,
+# see ee_bridge._memoized_graph
+GRAPH_GENERATION_KEY = 'ndfi_graph_generation'
+
+def bump_graph_generation():
+    """ invalidate the ee graphs memoized by every instance """
+    new_generation(GRAPH_GENERATION_KEY)
+
+def run_in_xg_transaction(func, *args, **kwargs):
+    """ run func in a cross group transaction, used to keep denormalized
+        counters in sync with the entities they count
+    """
+    options = db.create_transaction_options(xg=True)
+    return db.run_in_transaction_options(options, func, *args, **kwargs)
+
+def incr_counter(key, field, delta):
+    """ add delta to an integer field of the entity with the given key.
+        Must run inside a transaction. Uses db.put so Cell.put parent
+        update is not triggered
+    """
+    if not key:
+        return None
+    o = db.get(key)
+    if o:
+        setattr(o, field, max(0, (getattr(o, field) or 0) + delta))
+        db.put(o)
+    return o
+
 class User(db.Model):
 
     current_cells = db.IntegerProperty(default=0);
@@ -125,7 +175,7 @@ class Report(db.Model):
                                'start': timestamp(r[i].start),
                                'end': timestamp(r[i].end or date.today()),
                                'finished': r[i].finished,
-                               'cells_finished': r[i].cells_finished(),
+                               'cells_finished': r[i].cells_finished,
                                'type': 'report',
                                'visibility': True,
                                'total_cells': r[i].total_cells,
@@ -142,7 +192,8 @@ class Report(db.Model):
     
     
     
-    def cells_finished(self):
+    def count_cells_finished(self):
+        """ query the done cells, cells_finished holds the cached value """
         return Cell.all().filter('report =', self).filter('done =', True).count()
 
     def as_dict(self):
@@ -152,7 +203,7 @@ class Report(db.Model):
                 'start': timestamp(self.start),
                 'end': timestamp(self.end or date.today()),
                 'finished': self.finished,
-                'cells_finished': self.cells_finished(),
+                'cells_finished': self.cells_finished,
                 'total_cells': self.total_cells,
                 'str': self.start.strftime("%Y-%b-%d"),
                 'str_end': (self.end or date.today()).strftime("%Y-%b-%d"),
@@ -232,6 +283,11 @@ class Report(db.Model):
                                    self.start.isoformat())
 
 SPLITS = 5
+
+# parents of the cells saved in this request, written by
+# Cell.flush_parents. Instances are not threadsafe (see app.yaml)
+_dirty_parents = {}
+
 class Cell(db.Model):
 
     z = db.IntegerProperty(required=True)
@@ -244,6 +300,15 @@ class Cell(db.Model):
     ndfi_high = db.FloatProperty(default=0.3)
     ndfi_change_value = db.FloatProperty(default=0.0)
     done = db.BooleanProperty(default=False);
+    # denormalized counters, updated transactionally by Area.save,
+    # Area.delete, Note.save and Cell.save_done. Cell.put and put_many
+    # keep the stored values, and the done flag too
+    polygon_count = db.IntegerProperty(default=0)
+    note_count = db.IntegerProperty(default=0)
+    children_done = db.IntegerProperty(default=0)
+    COUNTERS = ('polygon_count', 'note_count', 'children_done')
+    # fields only written by incr_counter and save_done
+    STORED = COUNTERS + ('done',)
     last_change_by = db.UserProperty()
     last_change_on = db.DateTimeProperty(auto_now=True)
     compare_view = db.StringProperty(default='four')
@@ -272,22 +337,29 @@ class Cell(db.Model):
                                                       '"LANDSAT/LC8_L1T","true","NDFI T0","false","True color RGB141","false","False color RGB421","false",'
                                                       '"F color infrared RGB214","false",*')
 
+    def __init__(self, *args, **kwargs):
+        # new cells are stored under a deterministic key name so they
+        # can be fetched by key instead of querying
+        if (not args and 'key' not in kwargs and 'key_name' not in kwargs
+                and not kwargs.get('_from_entity')
+                and kwargs.get('report') is not None):
+            kwargs['key_name'] = Cell.key_name_for(kwargs['report'],
+                                                   kwargs.get('operation', 'sad'),
+                                                   kwargs['x'], kwargs['y'], kwargs['z'])
+        super(Cell, self).__init__(*args, **kwargs)
 
     @staticmethod
-    def get_cell(report, operation, x, y, z):
-        q = Cell.all()
-        q.filter("z =", z)
-        q.filter("x =", x)
-        q.filter("y =", y)
+    def key_name_for(report, operation, x, y, z):
+        """ key name for cell, <report_key>:<operation>:<z>_<x>_<y> """
         if operation == 'null':
-            q.filter("operation =", 'sad')
-        else:    
-            q.filter("operation =", operation)
-        q.filter("report =", report)
-        cell = q.fetch(1)
-        if cell:
-            return cell[0]
-        return None
+            operation = 'sad'
+        if isinstance(report, db.Model):
+            report = report.key()
+        return "%s:%s:%d_%d_%d" % (report, operation, z, x, y)
+
+    @staticmethod
+    def get_cell(report, operation, x, y, z):
+        return Cell.get_by_key_name(Cell.key_name_for(report, operation, x, y, z))
 
     def child(self, i, j):
         zz = self.z+1
@@ -297,27 +369,24 @@ class Cell(db.Model):
 
     def children(self):
         """ return child cells """
-        eid = self.external_id()
-        childs = Cell.all()
-        childs.filter('report =', self.report)
-        childs.filter('parent_id =', eid)
-        childs.filter('operation = ', self.operation)
-
-        children_cells = dict((x.external_id(), x) for x in childs.fetch(SPLITS*SPLITS))
-
-        cells = []
+        report = Cell.report.get_value_for_datastore(self)
+        zz = self.z+1
+        pos = []
         for i in xrange(SPLITS):
             for j in xrange(SPLITS):
-                zz = self.z+1
                 xx = (SPLITS**self.z)*self.x + i
                 yy = (SPLITS**self.z)*self.y + j
+                pos.append((xx, yy))
 
-                cid= "_".join(map(str,(zz, xx, yy)))
-                if cid in children_cells:
-                    cell = children_cells[cid]
-                else:
-                    cell = Cell.default_cell(self.report, self.operation, xx, yy, zz)
-                cells.append(cell)
+        # one batch get for all the children
+        names = [Cell.key_name_for(report, self.operation, xx, yy, zz) for xx, yy in pos]
+        stored = Cell.get_by_key_name(names)
+
+        cells = []
+        for (xx, yy), cell in zip(pos, stored):
+            if not cell:
+                cell = Cell.default_cell(self.report, self.operation, xx, yy, zz)
+            cells.append(cell)
         return cells
 
     def calculate_ndfi_change_from_childs(self):
@@ -340,12 +409,136 @@ class Cell(db.Model):
 
     def put(self):
         self.parent_id = self.calc_parent_id()
-        p = self.get_parent()
-        # update parent
-        if p:
-            p.last_change_by = self.last_change_by
-            p.put()
-        super(Cell, self).put()
+        ret = Cell._put_keeping_counters([self])[0]
+        self.mark_parent_dirty()
+        return ret
+
+    @staticmethod
+    def put_many(cells):
+        """ put a list of cells in one rpc """
+        for c in cells:
+            c.parent_id = c.calc_parent_id()
+        keys = Cell._put_keeping_counters(cells)
+        for c in cells:
+            c.mark_parent_dirty()
+        return keys
+
+    @staticmethod
+    def _keep_stored(cells):
+        """ copy the counters and done flag of the stored entities to
+            cells, only incr_counter and save_done change them and the
+            instances may have been loaded before. Cells not stored yet
+            are not done. Must run in a transaction
+        """
+        keyed = [c for c in cells if c.has_key()]
+        stored = dict((id(c), s) for c, s in zip(keyed, db.get([c.key() for c in keyed])))
+        for c in cells:
+            s = stored.get(id(c))
+            if s:
+                for field in Cell.STORED:
+                    setattr(c, field, getattr(s, field))
+            else:
+                c.done = False
+
+    @staticmethod
+    def _put_keeping_counters(cells):
+        """ put cells keeping the stored counters and done flag, see
+            _keep_stored
+        """
+        def txn(cells):
+            Cell._keep_stored(cells)
+            return db.put(cells)
+
+        if db.is_in_transaction():
+            return txn(cells)
+        keys = []
+        # xg transactions are limited to 25 entity groups
+        for i in xrange(0, len(cells), 25):
+            keys.extend(run_in_xg_transaction(txn, cells[i:i + 25]))
+        return keys
+
+    def mark_parent_dirty(self):
+        """ parent is not written here but on flush_parents so siblings
+            saved in the same request update it only once
+        """
+        if self.z == 0:
+            return
+        z, x, y = Cell.cell_id(self.calc_parent_id())
+        report = Cell.report.get_value_for_datastore(self)
+        name = Cell.key_name_for(report, self.operation, x, y, z)
+        _dirty_parents[name] = (report, self.operation, x, y, z, self.last_change_by)
+
+    @staticmethod
+    def flush_parents():
+        """ create or update the parents marked by put, level by level up
+            to the root. Called after each request, code running outside a
+            request (deferred tasks) must call it
+        """
+        def txn(names, pending):
+            stored = Cell.get_by_key_name(names)
+            cells = []
+            for name, cell in zip(names, stored):
+                report, operation, x, y, z, by = pending[name]
+                if not cell:
+                    cell = Cell.default_cell(report, operation, x, y, z)
+                cell.parent_id = cell.calc_parent_id()
+                cell.last_change_by = by
+                cells.append(cell)
+            db.put(cells)
+            return cells
+
+        while _dirty_parents:
+            pending = dict(_dirty_parents)
+            _dirty_parents.clear()
+            names = pending.keys()
+            # the transaction avoids overwriting counters updated meanwhile,
+            # xg transactions are limited to 25 entity groups
+            for i in xrange(0, len(names), 25):
+                for cell in run_in_xg_transaction(txn, names[i:i + 25], pending):
+                    cell.mark_parent_dirty()
+
+    @staticmethod
+    def discard_parents():
+        """ forget parents marked and not flushed """
+        _dirty_parents.clear()
+
+    def save_done(self, done, put=False):
+        """ change done flag of a saved cell updating parent children_done
+            and report cells_finished in the same transaction. With put
+            the other fields of this instance are saved in it too
+        """
+        if put:
+            self.parent_id = self.calc_parent_id()
+            self.mark_parent_dirty()
+        # parent must exist to get its counter updated
+        Cell.flush_parents()
+        parent = self.get_parent()
+        parent_key = parent.key() if parent and parent.is_saved() else None
+        report_key = Cell.report.get_value_for_datastore(self)
+        key = self.key()
+
+        def txn():
+            if put:
+                cell = self
+                Cell._keep_stored([cell])
+            else:
+                cell = db.get(key)
+            if cell.done == done:
+                if put:
+                    db.put(cell)
+                return cell
+            delta = 1 if done else -1
+            cell.done = done
+            db.put(cell)
+            incr_counter(parent_key, 'children_done', delta)
+            incr_counter(report_key, 'cells_finished', delta)
+            return cell
+
+        cell = run_in_xg_transaction(txn)
+        self.done = cell.done
+        self.children_done = cell.children_done
+        self.polygon_count = cell.polygon_count
+        self.note_count = cell.note_count
 
     @staticmethod
     def cell_id(id):
@@ -407,15 +600,11 @@ class Cell(db.Model):
         key_id = '' 
         try:
             key_id = self.key()
-            note_count = self.note_set.count()
             t = timestamp(self.last_change_on)
             if self.last_change_by:
                 by = self.last_change_by.nickname()
-            children_done = self.children_done()
         except:
-            note_count = 0
             t = 0
-            children_done = 0
 
         return {                
                 'key': str(key_id),
@@ -423,7 +612,8 @@ class Cell(db.Model):
                 'z': self.z,
                 'x': self.x,
                 'y': self.y,
-                'report_id': str(self.report.key()),
+                # avoid dereferencing the report, only the key is needed
+                'report_id': str(Cell.report.get_value_for_datastore(self)),
                 'ndfi_low': self.ndfi_low,
                 'ndfi_high': self.ndfi_high,
                 'ndfi_change_value': self.ndfi_change_value,
@@ -436,13 +626,21 @@ class Cell(db.Model):
                 'done': self.done,
                 'latest_change': t,
                 'added_by': by,
-                'polygon_count': self.polygon_count(),
-                'note_count': note_count,
-                'children_done': children_done,
+                'polygon_count': self.polygon_count,
+                'note_count': self.note_count,
+                'children_done': self.children_done,
                 'blocked': self.external_id() in CELL_BLACK_LIST
         }
 
-    def polygon_count(self):
+    @staticmethod
+    def as_dict_many(cells):
+        """ as_dict for a list of sibling cells. Counts are read from the
+            denormalized counters so no query is run per cell
+        """
+        return [c.as_dict() for c in cells]
+
+    def count_polygons(self):
+        """ query the cell areas, polygon_count holds the cached value """
         try:
             self.key()
         except:
@@ -470,7 +668,14 @@ class Cell(db.Model):
         else:
             return None        
 
-    def children_done(self):
+    def count_notes(self):
+        """ query the cell notes, note_count holds the cached value """
+        if not self.is_saved():
+            return 0
+        return self.note_set.count()
+
+    def count_children_done(self):
+        """ query the done children, children_done holds the cached value """
         eid = self.external_id()
         childs = Cell.all()
         childs.filter('report =', self.report)
@@ -499,19 +704,8 @@ class Cell(db.Model):
             ne and sw a (lat, lon) tuple
             return bounds in the same format
         """
-        righttop = Mercator.project(*top_level_bounds[0]) #ne
-        leftbottom = Mercator.project(*top_level_bounds[1]) #sw
-        topx = leftbottom[0]
-        topy = righttop[1]
-        w = righttop[0] - leftbottom[0];
-        h = -righttop[1] + leftbottom[1];
-        sp = SPLITS**self.z
-        sx = w/sp;
-        sy = h/sp;
-        return (
-            Mercator.unproject((self.x + 1)*sx + topx, (self.y)*sy + topy),
-            Mercator.unproject(self.x*sx + topx, topy + (self.y+1)*sy)
-        )
+        # grid edges are computed once per level, see grid.py
+        return grid.cell_bounds(top_level_bounds, self.z, self.x, self.y, SPLITS)
 
     def bbox_polygon(self, top_bounds):
         bounds = self.bounds(top_bounds)
@@ -525,27 +719,13 @@ class CellGrid(db.Model):
     name = db.StringProperty(required=True)
     parent_name = db.StringProperty()        
     last_change_on = db.DateTimeProperty(auto_now=True)
-    geo = db.TextProperty(required=True)
+    geo = GeometryProperty(required=True)
     
     @property
     def tiles(self):
-        geo_cell_grid = ee.Geometry.Polygon(ast.literal_eval(self.geo))
-        q = Tile.all().filter('cells =', self.name)
-        r = q.fetch(300)                
-        result = []
-        
-        for i in range(len(r)):
-            geo_tile = ee.Geometry.Polygon(ast.literal_eval(r[i].geo))
-            #intersection = geo_cell_grid.intersection(geo_tile, ee.ErrorMargin(30.0, "meters"), "EPSG:4326")
-                        
-            #if len(intersection.getInfo()['coordinates']) > 0:
-            if geo_cell_grid.intersects(geo_tile, ee.ErrorMargin(30.0, "meters"), "EPSG:4326").getInfo():
-                r[i].save_cells(self.name, False)
-                result.append(r[i])
-            else:
-                r[i].save_cells(self.name, True)
-        
-        return result
+        """ tiles covering this cell, read from Tile.snapshot """
+        snapshot = Tile.snapshot()
+        return [snapshot.tiles[name] for name in snapshot.tiles_by_cell.get(self.name, [])]
     
     def tiles_as_dict(self):
         tiles = self.tiles
@@ -577,6 +757,16 @@ class CellGrid(db.Model):
         else:
             return None
     
+    @staticmethod
+    def by_names(names):
+        """ name -> CellGrid dict of the grids with the given names """
+        names = list(names)
+        grids = {}
+        for i in range(0, len(names), 30):
+            for g in CellGrid.all().filter('name IN', names[i:i+30]):
+                grids[g.name] = g
+        return grids
+
     @staticmethod
     def find_by_parent_name(parent_name):
         q = CellGrid.all().filter("parent_name =", parent_name)
@@ -586,6 +776,26 @@ class CellGrid(db.Model):
         else:
             return None
 
+    def update_tiles(self):
+        """ update Tile.covers of the tiles listing this cell """
+        intersecting = set(Tile.index().intersecting(self.geo.coordinates))
+        changed = []
+        for tile in Tile.all().filter('cells =', self.name).fetch(300):
+            if not tile.covers_updated:
+                tile.update_covers()
+                changed.append(tile)
+                continue
+            covers = tile.name in intersecting
+            if covers != (self.name in tile.covers):
+                if covers:
+                    tile.covers.append(self.name)
+                else:
+                    tile.covers.remove(self.name)
+                changed.append(tile)
+        if changed:
+            db.put(changed)
+            Tile.invalidate_snapshot()
+
     def save(self):
         z, x, y = self.name.split('_')
         z_parent = str(int(z) - 1)
@@ -601,21 +811,49 @@ class CellGrid(db.Model):
                 r[0].geo         = self.geo   
                 r[0].parent_name = self.parent_name                        
                 r[0].put()
+                r[0].update_tiles()
                 return 'Cell updated.'  
             else:
                 self.put()
+                self.update_tiles()
                 return 'Cell saved.'
 
             
         except:
             return 'Could not save cell.'
-        
+
+
+class TileSnapshot(object):
+    """ all the tiles with their footprints index and cell membership in
+        both directions. Built by Tile.snapshot, don't modify the tiles
+    """
+
+    def __init__(self, tiles):
+        self.tiles = dict((t.name, t) for t in tiles)
+        self.index = spatial.STRTree([(t.name, t.geo.coordinates) for t in tiles])
+        self.cells_by_tile = dict((t.name, list(t.covers)) for t in tiles)
+        self.tiles_by_cell = {}
+        for t in sorted(tiles, key=lambda t: t.name):
+            for cell in t.covers:
+                self.tiles_by_cell.setdefault(cell, []).append(t.name)
+
+# [snapshot, generation] of the tiles, see Tile.snapshot
+_tile_snapshot = [None, None]
+TILE_SNAPSHOT_GENERATION_KEY = 'tile_snapshot_generation'
+
 class Tile(db.Model):
     sensor = db.StringProperty(required=True)
     name = db.StringProperty(required=True)
+    # cells the tile was created for
     cells = db.StringListProperty(required=True)
+    # the ones its footprint intersects, or all of them while the cell
+    # has no CellGrid. Kept by Tile.save and CellGrid.save
+    covers = db.StringListProperty()
+    # false for tiles saved before covers existed, their covers are
+    # computed when the snapshot is built until update_tile_covers runs
+    covers_updated = db.BooleanProperty(default=False)
     last_change_on = db.DateTimeProperty(auto_now=True)
-    geo = db.TextProperty(required=True)
+    geo = GeometryProperty(required=True)
     
     
     
@@ -633,16 +871,20 @@ class Tile(db.Model):
     
     @staticmethod
     def find_by_cell_name(cell_name):
-        q = Tile.all().filter('cells =', cell_name)
-        r = q.fetch(100)
-        if r:
+        snapshot = Tile.snapshot()
+        names = snapshot.tiles_by_cell.get(cell_name)
+        if names:
             tiles = {}
-            for i in range(len(r)):
-                tiles.update({'tile'+str(i): r[i].as_dict()})
+            for i in range(len(names)):
+                tiles.update({'tile'+str(i): snapshot.tiles[names[i]].as_dict()})
             return tiles
         else:
             return None
-        
+
+    @staticmethod
+    def find_cells_by_tile_name(name):
+        """ names of the cells covered by the tile """
+        return Tile.snapshot().cells_by_tile.get(name, [])
         
     @staticmethod
     def find_tiles_by_sensor(sensor):
@@ -655,13 +897,51 @@ class Tile(db.Model):
             return tiles
         else:
             return []
+
+    @staticmethod
+    def fetch_all():
+        """ every tile, read in batches with a cursor """
+        tiles = []
+        q = Tile.all()
+        batch = q.fetch(500)
+        while batch:
+            tiles.extend(batch)
+            q = Tile.all().with_cursor(q.cursor())
+            batch = q.fetch(500)
+        return tiles
+
+    @staticmethod
+    def snapshot():
+        """ TileSnapshot built once per instance and rebuilt when some tile
+            membership or footprint changes
+        """
+        generation = current_generation(TILE_SNAPSHOT_GENERATION_KEY)
+        if _tile_snapshot[0] is None or generation != _tile_snapshot[1]:
+            tiles = Tile.fetch_all()
+            # not migrated yet, computed in memory and not saved
+            stale = [t for t in tiles if not t.covers_updated]
+            if stale:
+                grids = CellGrid.by_names(set(c for t in stale for c in t.cells))
+                for t in stale:
+                    t.update_covers(grids)
+            _tile_snapshot[:] = [TileSnapshot(tiles), generation]
+        return _tile_snapshot[0]
+
+    @staticmethod
+    def invalidate_snapshot():
+        new_generation(TILE_SNAPSHOT_GENERATION_KEY)
+        _tile_snapshot[0] = None
+
+    @staticmethod
+    def index():
+        """ spatial index of tile footprints by tile name """
+        return Tile.snapshot().index
         
     @staticmethod
     def find_geo_region(name):
-        q = Tile.all().filter('name =', name)
-        r = q.fetch(1)
-        if r:             
-            return  ast.literal_eval(r[0].geo) 
+        tile = Tile.snapshot().tiles.get(name)
+        if tile:             
+            return tile.geo.coordinates
         else:
             return None
         
@@ -675,7 +955,17 @@ class Tile(db.Model):
             else:
                 self.cells.append(name)
                 self.put()    
-            
+
+    def update_covers(self, grids=None):
+        """ set covers testing the footprint against the cell grids, a
+            name -> CellGrid dict read from the datastore if not given
+        """
+        if grids is None:
+            grids = CellGrid.by_names(self.cells)
+        polygon = self.geo.coordinates
+        self.covers = [c for c in self.cells
+                       if c not in grids or spatial.polygons_intersect(polygon, grids[c].geo.coordinates)]
+        self.covers_updated = True
                 
     
     def save(self):  
@@ -690,25 +980,28 @@ class Tile(db.Model):
                                 
                 r[0].sensor = self.sensor
                 r[0].geo    = self.geo   
+                r[0].update_covers()
                 r[0].put()
+                Tile.invalidate_snapshot()
                 
                 return 'Cell updated.' 
             else:
+                self.update_covers()
                 self.put()
+                Tile.invalidate_snapshot()
                 return 'Cell saved.'
 
             
         except:
             return 'Could not save cell.'
 
-
 class Area(db.Model):
     """ area selected by user """
 
     DEGRADATION = 0
     DEFORESTATION = 1
 
-    geo = db.TextProperty(required=True)
+    geo = GeometryProperty(required=True)
     added_by = db.UserProperty()
     added_on = db.DateTimeProperty(auto_now_add=True)
     type = db.IntegerProperty(required=True)
@@ -720,7 +1013,7 @@ class Area(db.Model):
                 'id': str(self.key()),
                 'key': str(self.key()),
                 'cell': str(self.cell.key()),
-                'paths': json.loads(self.geo),
+                'paths': self.geo.coordinates,
                 'type': self.type,
                 'fusion_tables_id': self.fusion_tables_id,
                 'added_on': timestamp(self.added_on),
@@ -744,10 +1037,9 @@ class Area(db.Model):
             return None
     
     def as_feature(self):
-        geo = self.geo
-        polygon = ast.literal_eval(geo)
-        for i in range(len(polygon[0])):
-            polygon[0][i] = polygon[0][i][::-1]
+        polygon = list(self.geo.coordinates)
+        # copy the outer ring, the decoded coordinates are cached
+        polygon[0] = [p[::-1] for p in polygon[0]]
         geometry = ee.Geometry.Polygon(polygon)
         properties = self.as_dict()
         return ee.Feature(geometry, properties)
@@ -759,17 +1051,35 @@ class Area(db.Model):
             self.key()
         except db.NotSavedError:
             exists = False
-        ret = self.put()
-        # call defer AFTER saving instance
-        if not exists:
-            deferred.defer(self.create_fusion_tables)
-        else:
-            deferred.defer(self.update_fusion_tables)
+
+        def txn():
+            if exists:
+                # keep the rowid set by AreaSync.drain after this instance
+                # was loaded
+                stored = db.get(self.key())
+                if stored and stored.fusion_tables_id:
+                    self.fusion_tables_id = stored.fusion_tables_id
+            ret = self.put()
+            if not exists:
+                incr_counter(Area.cell.get_value_for_datastore(self), 'polygon_count', 1)
+            AreaSync.journal(self, AreaSync.UPDATE if exists else AreaSync.CREATE)
+            return ret
+        ret = run_in_xg_transaction(txn)
+        # fusion tables are updated in batches, see AreaSync
+        AreaSync.schedule_drain()
         return ret
 
     def delete(self):
-        super(Area, self).delete()
-        deferred.defer(self.delete_fusion_tables)
+        cell_key = Area.cell.get_value_for_datastore(self)
+
+        def txn():
+            stored = db.get(self.key()) or self
+            super(Area, self).delete()
+            incr_counter(cell_key, 'polygon_count', -1)
+            AreaSync.journal(stored, AreaSync.DELETE)
+        run_in_xg_transaction(txn)
+        AreaSync.schedule_drain()
+
     @staticmethod
     def _get_ft_client():
         cl = FT(settings.FT_CONSUMER_KEY,
@@ -787,27 +1097,302 @@ class Area(db.Model):
             return 8
         return 7
 
+    @staticmethod
+    def _delete_sql(table_id, rowid):
+        return "delete from %s where rowid = '%s'" % (table_id, rowid)
+
+    def _update_sql(self, table_id):
+        geo_kml = path_to_kml(self.geo.coordinates)
+        return "update  %s set geo = '%s', type = '%s' where rowid = '%s'" % (table_id, geo_kml, self.fusion_tables_type(), self.fusion_tables_id)
+
+    def _insert_sql(self, table_id):
+        geo_kml = path_to_kml(self.geo.coordinates)
+        report_id = Cell.report.get_value_for_datastore(self.cell).id()
+        return "insert into %s ('geo', 'added_on', 'type', 'report_id') VALUES ('%s', '%s', %d, %d)" % (table_id, geo_kml, self.added_on, self.fusion_tables_type(), report_id)
+
+    def _find_sql(self, table_id):
+        """ query for the row inserted for this area """
+        report_id = Cell.report.get_value_for_datastore(self.cell).id()
+        return "select rowid from %s where added_on = '%s' and report_id = %d" % (table_id, self.added_on, report_id)
+
+    @staticmethod
+    def _rowid_copy_sql(table_id, rowid):
+        return "update %s set rowid_copy = '%s' where rowid = '%s'" % (table_id, rowid, rowid)
+
     def delete_fusion_tables(self):
         """ delete area from fusion tables. Do not use this method directly, call delete method"""
         cl = self._get_ft_client()
         table_id = cl.table_id(settings.FT_TABLE)
-        cl.sql("delete from %s where rowid = '%s'" % (table_id, self.fusion_tables_id))
+        cl.sql(self._delete_sql(table_id, self.fusion_tables_id))
     def update_fusion_tables(self):
         """ update polygon in fusion tables. Do not call this method, use save method when change instance data """
         cl = self._get_ft_client()
         table_id = cl.table_id(settings.FT_TABLE)
-        geo_kml = path_to_kml(json.loads(self.geo))
-        cl.sql("update  %s set geo = '%s', type = '%s' where rowid = '%s'" % (table_id, geo_kml, self.fusion_tables_type(), self.fusion_tables_id))
+        cl.sql(self._update_sql(table_id))
 
     def create_fusion_tables(self):
         cl = self._get_ft_client()
         table_id = cl.table_id(settings.FT_TABLE)
-        geo_kml = path_to_kml(json.loads(self.geo))
-        rowid = cl.sql("insert into %s ('geo', 'added_on', 'type', 'report_id') VALUES ('%s', '%s', %d, %d)" % (table_id, geo_kml, self.added_on, self.fusion_tables_type(), self.cell.report.key().id()))
+        rowid = cl.sql(self._insert_sql(table_id))
         self.fusion_tables_id = int(rowid.split('\n')[1])
-        rowid = cl.sql("update %s set rowid_copy = '%s' where rowid = '%s'" % (table_id, self.fusion_tables_id, self.fusion_tables_id))
+        rowid = cl.sql(self._rowid_copy_sql(table_id, self.fusion_tables_id))
         self.put()
 
+class AreaSync(db.Model):
+    """ pending fusion tables change for an Area. Saved as child of the
+        area with key name 'sync' in the same transaction that changes the
+        area, so there is at most one entry per area and successive edits
+        are coalesced. Entries are sent in batches by AreaSync.drain
+    """
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    op = db.StringProperty(required=True)
+    # needed to delete the row once the area is gone
+    fusion_tables_id = db.IntegerProperty()
+    # changed on each journal write, an entry is only removed if it was
+    # not changed while it was being sent
+    version = db.IntegerProperty(default=0)
+    # number of times an insert was sent for this entry
+    attempts = db.IntegerProperty(default=0)
+    # failed sends of this version and the last error, see _fail
+    failures = db.IntegerProperty(default=0)
+    error = db.TextProperty()
+    added_on = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def journal(area, op):
+        """ record a change of area, must run in the transaction that
+            changes the area
+        """
+        e = AreaSync.get_by_key_name('sync', parent=area)
+        if e and e.op == AreaSync.CREATE:
+            if op != AreaSync.DELETE:
+                # the insert reads the current area data
+                op = AreaSync.CREATE
+            elif not area.fusion_tables_id:
+                # never sent, nothing to do. If it is being sent right now
+                # drain deletes the row when it finds the area is gone
+                e.delete()
+                return
+            # else drain already inserted it, the row is deleted by rowid
+        if not e:
+            e = AreaSync(parent=area, key_name='sync', op=op)
+        e.op = op
+        e.fusion_tables_id = area.fusion_tables_id
+        e.version += 1
+        # the new data may not fail
+        e.failures = 0
+        e.put()
+
+    @staticmethod
+    def schedule_drain():
+        """ add a drain task, only one per settings.FT_SYNC_DELAY
+            seconds so changes in that time are sent together
+        """
+        bucket = int(_time.time())/settings.FT_SYNC_DELAY
+        try:
+            deferred.defer(AreaSync.drain,
+                           _name='ft-sync-%d' % bucket,
+                           _countdown=settings.FT_SYNC_DELAY,
+                           _queue=settings.FT_SYNC_QUEUE)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def backlog():
+        """ number of pending changes, date of the oldest one and number
+            of entries moved aside
+        """
+        oldest = AreaSync.all().order('added_on').fetch(1)
+        return {
+            'pending': AreaSync.all(keys_only=True).count(),
+            'oldest': timestamp(oldest[0].added_on) if oldest else None,
+            'failed': AreaSyncFailure.all(keys_only=True).count()
+        }
+
+    @staticmethod
+    def drain():
+        """ send pending changes to fusion tables. Inserts for the new
+            areas go in a single request.
+
+            Must run in the settings.FT_SYNC_QUEUE queue, which runs one
+            task at a time, so two drains never send the same entries.
+            Safe to retry: inserts already sent are looked up before
+            sending them again. An entry that fails is kept for the next
+            drain and the others are sent anyway, after
+            settings.FT_SYNC_MAX_FAILURES failures it is moved to
+            AreaSyncFailure
+        """
+        entries = AreaSync.all().order('added_on').fetch(settings.FT_SYNC_BATCH)
+        if not entries:
+            return
+        cl = Area._get_ft_client()
+        table_id = cl.table_id(settings.FT_TABLE)
+        areas = db.get([e.parent_key() for e in entries])
+
+        # (entry, error) pairs, error is None for the entries sent
+        result = []
+        creates = []
+        for e, area in zip(entries, areas):
+            if e.op == AreaSync.DELETE:
+                if e.fusion_tables_id:
+                    result.append((e, AreaSync._send(cl, Area._delete_sql(table_id, e.fusion_tables_id))))
+                else:
+                    result.append((e, None))
+            elif not area:
+                # deleted meanwhile, its delete entry comes next
+                result.append((e, None))
+            elif not area.fusion_tables_id:
+                creates.append((e, area))
+            else:
+                # fusion tables only allows one update or delete per statement
+                result.append((e, AreaSync._send(cl, area._update_sql(table_id))))
+        if creates:
+            result.extend(AreaSync._send_creates(cl, table_id, creates))
+
+        failed = 0
+        for e, error in result:
+            if error is None:
+                run_in_xg_transaction(AreaSync._done, e.key(), e.version)
+            else:
+                failed += 1
+                logging.error("fusion tables change for %s failed: %s" % (e.parent_key(), error))
+                run_in_xg_transaction(AreaSync._fail, e.key(), e.version, unicode(error))
+        logging.info("%d fusion tables changes sent, %d failed" % (len(entries) - failed, failed))
+        if len(entries) == settings.FT_SYNC_BATCH:
+            deferred.defer(AreaSync.drain, _queue=settings.FT_SYNC_QUEUE)
+        elif failed:
+            AreaSync.schedule_drain()
+
+    @staticmethod
+    def _send(cl, statement):
+        """ run statement, returns the error or None """
+        try:
+            cl.sql(statement)
+        except Exception, e:
+            return e
+        return None
+
+    @staticmethod
+    def _send_creates(cl, table_id, creates):
+        """ insert the rows of creates, a list of (entry, area) pairs.
+            Returns (entry, error) pairs
+        """
+        result = []
+        batch = []
+        for e, area in creates:
+            try:
+                if e.attempts and AreaSync._find_row(cl, table_id, area):
+                    # inserted by an earlier drain, send the current data
+                    if area.fusion_tables_id:
+                        cl.sql(area._update_sql(table_id))
+                    result.append((e, None))
+                elif e.failures:
+                    # alone so it can't make the batch fail again
+                    AreaSync._insert(cl, table_id, [(e, area)])
+                    result.append((e, None))
+                else:
+                    batch.append((e, area))
+            except Exception, error:
+                result.append((e, error))
+        if batch:
+            error = None
+            try:
+                AreaSync._insert(cl, table_id, batch)
+            except Exception, error:
+                pass
+            result.extend((e, error) for e, area in batch)
+        return result
+
+    @staticmethod
+    def _find_row(cl, table_id, area):
+        """ look up the row of an area whose insert was sent, true if it
+            was found
+        """
+        found = cl.sql(area._find_sql(table_id)).split('\n')[1:]
+        found = [x for x in found if x.strip()]
+        if found:
+            AreaSync._set_rowid(cl, table_id, area, int(found[0]))
+        return bool(found)
+
+    @staticmethod
+    def _insert(cl, table_id, pending):
+        for e, area in pending:
+            run_in_xg_transaction(AreaSync._count_attempt, e.key())
+        result = cl.sql_batch([area._insert_sql(table_id) for e, area in pending])
+        rowids = []
+        for r in result:
+            rowids.extend(int(x) for x in r.split('\n')[1:] if x.strip())
+        if len(rowids) != len(pending):
+            raise Exception("fusion tables returned %d rowids for %d inserts" % (len(rowids), len(pending)))
+        for (e, area), rowid in zip(pending, rowids):
+            AreaSync._set_rowid(cl, table_id, area, rowid)
+
+    @staticmethod
+    def _count_attempt(key):
+        """ only touches attempts, the entry may have been journaled again
+            since drain loaded it
+        """
+        e = db.get(key)
+        if e:
+            e.attempts += 1
+            e.put()
+
+    @staticmethod
+    def _set_rowid(cl, table_id, area, rowid):
+        def txn():
+            a = db.get(area.key())
+            if a:
+                a.fusion_tables_id = rowid
+                db.put(a)
+            return a
+        if not run_in_xg_transaction(txn):
+            # area deleted while it was being inserted
+            cl.sql(Area._delete_sql(table_id, rowid))
+            return
+        area.fusion_tables_id = rowid
+        cl.sql(Area._rowid_copy_sql(table_id, rowid))
+
+    @staticmethod
+    def _done(key, version):
+        e = db.get(key)
+        if e and e.version == version:
+            e.delete()
+
+    @staticmethod
+    def _fail(key, version, error):
+        """ count a failed send, moving the entry to AreaSyncFailure when
+            there are too many
+        """
+        e = db.get(key)
+        if not e or e.version != version:
+            # changed meanwhile, the new data is sent next time
+            return
+        e.failures += 1
+        e.error = error
+        if e.failures < settings.FT_SYNC_MAX_FAILURES:
+            e.put()
+            return
+        AreaSyncFailure(parent=e.parent_key(),
+                        op=e.op,
+                        fusion_tables_id=e.fusion_tables_id,
+                        attempts=e.attempts,
+                        error=error).put()
+        e.delete()
+
+class AreaSyncFailure(db.Model):
+    """ AreaSync entry that failed settings.FT_SYNC_MAX_FAILURES times,
+        kept as child of the area to be checked and sent by hand. If
+        attempts is not 0 the row may have been inserted
+    """
+    op = db.StringProperty(required=True)
+    fusion_tables_id = db.IntegerProperty()
+    attempts = db.IntegerProperty(default=0)
+    error = db.TextProperty()
+    added_on = db.DateTimeProperty(auto_now_add=True)
+
 class Note(db.Model):
     """ user note on a cell """
 
@@ -816,6 +1401,17 @@ class Note(db.Model):
     added_on = db.DateTimeProperty(auto_now_add=True)
     cell = db.ReferenceProperty(Cell)
 
+    def save(self):
+        """ put the note and update the cell note counter """
+        exists = self.is_saved()
+
+        def txn():
+            ret = self.put()
+            if not exists:
+                incr_counter(Note.cell.get_value_for_datastore(self), 'note_count', 1)
+            return ret
+        return run_in_xg_transaction(txn)
+
     def as_dict(self):
         return {'id': str(self.key()),
                 'msg': self.msg,
@@ -836,6 +1432,8 @@ class Error(db.Model):
 class StatsStore(db.Model):
     report_id = db.StringProperty()
     json = db.TextProperty()
+    # True when the stats are also saved as ZoneStats rows
+    rows_saved = db.BooleanProperty(default=False)
 
     @staticmethod
     def get_for_report(id):
@@ -868,26 +1466,169 @@ class StatsStore(db.Model):
             'deg': reduce(operator.add, map(float, (x['deg'] for x in table_stats)))
         }]
 
+    def save_rows(self):
+        """ save the json stats as ZoneStats rows """
+        ZoneStats.save_report(self.report_id, self.as_dict()['stats'])
+        self.rows_saved = True
+        self.put()
+
+class ZoneStats(db.Model):
+    """ stats for one zone of a region table in a report, saved under
+        <report_id>:<table>:<zone> key name so a zone is a get by key and
+        a table is a query by report_id and table
+    """
+    report_id = db.StringProperty()
+    table = db.StringProperty()
+    zone = db.StringProperty()
+    deforestation = db.FloatProperty(default=0.0)
+    degradation = db.FloatProperty(default=0.0)
+    total_area = db.FloatProperty(default=0.0)
+
+    @staticmethod
+    def key_name_for(report_id, table, zone):
+        return "%s:%s:%s" % (report_id, table, zone)
+
+    @staticmethod
+    def save_report(report_id, stats):
+        """ save rows for stats in StatsStore json format, a dict of
+            {'table': .., 'id': .., 'def': .., 'deg': ..} dicts. Rows of
+            the report for zones not in stats are deleted
+        """
+        rows = []
+        for x in stats.itervalues():
+            table, zone = str(x['table']), str(x['id'])
+            rows.append(ZoneStats(key_name=ZoneStats.key_name_for(report_id, table, zone),
+                                  report_id=report_id,
+                                  table=table,
+                                  zone=zone,
+                                  deforestation=float(x['def']),
+                                  degradation=float(x['deg']),
+                                  total_area=float(x.get('total_area', 0.0))))
+        for i in xrange(0, len(rows), 500):
+            db.put(rows[i:i + 500])
+        names = set(r.key().name() for r in rows)
+        q = ZoneStats.all(keys_only=True).filter('report_id =', report_id)
+        stale = [k for k in q if k.name() not in names]
+        for i in xrange(0, len(stale), 500):
+            db.delete(stale[i:i + 500])
+
+    @staticmethod
+    def _load(report_id, table, zone=None):
+        """ stats rows for a table or a zone. Rows are created from the
+            StatsStore json the first time they are needed
+        """
+        def fetch():
+            if zone:
+                row = ZoneStats.get_by_key_name(ZoneStats.key_name_for(report_id, table, zone))
+                return [row] if row else []
+            q = ZoneStats.all().filter('report_id =', report_id).filter('table =', str(table))
+            return q.fetch(10000)
+
+        rows = fetch()
+        if not rows:
+            st = StatsStore.get_for_report(report_id)
+            if st and not st.rows_saved:
+                st.save_rows()
+                rows = fetch()
+        return rows
+
+    @staticmethod
+    def for_table(report_id, table, zone=None):
+        """ same as StatsStore.for_table """
+        return [x.as_dict() for x in ZoneStats._load(report_id, table, zone)]
+
+    @staticmethod
+    def table_accum(report_id, table, zone=None):
+        """ same as StatsStore.table_accum """
+        rows = ZoneStats._load(report_id, table, zone)
+        if not rows:
+            return None
+        return [{
+            'id': zone,
+            'def': sum(x.deforestation for x in rows),
+            'deg': sum(x.degradation for x in rows)
+        }]
+
+    def as_dict(self):
+        return {
+            'id': self.zone,
+            'table': self.table,
+            'def': self.deforestation,
+            'deg': self.degradation,
+            'total_area': self.total_area
+        }
+
+# zone names by table loaded by this instance, dropped when the memcache
+# generation changes (see FustionTablesNames.invalidate_names)
+_table_names = {}
+_table_names_generation = [None]
+TABLE_NAMES_GENERATION_KEY = 'fusion_tables_names_generation'
+
 class FustionTablesNames(db.Model):
     table_id = db.StringProperty()
     json = db.TextProperty()
     def as_dict(self):
         return json.loads(self.json)
 
+    @staticmethod
+    def names(table_id):
+        """ zone id -> name dict for table, parsed once per instance """
+        generation = current_generation(TABLE_NAMES_GENERATION_KEY)
+        if generation != _table_names_generation[0]:
+            _table_names.clear()
+            _table_names_generation[0] = generation
+        table_id = str(table_id)
+        if table_id not in _table_names:
+            r = FustionTablesNames.all().filter('table_id =', table_id).fetch(1)
+            _table_names[table_id] = r[0].as_dict() if r else {}
+        return _table_names[table_id]
+
+    @staticmethod
+    def invalidate_names():
+        """ make every instance reload the names """
+        new_generation(TABLE_NAMES_GENERATION_KEY)
+        _table_names.clear()
+
 #FT_TABLE_PICKER = 'Merged and Exported SAD inclusions - Testes Image Picker'
 
 
+# names of the migrations known to be finished, see Migration
+_migrations_done = set()
+
+class Migration(db.Model):
+    """ saved with the migration name as key name when a data migration
+        command finishes, so code can stop handling the old data
+    """
+    finished_on = db.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def is_done(name):
+        if name not in _migrations_done:
+            if not Migration.get_by_key_name(name):
+                return False
+            _migrations_done.add(name)
+        return True
+
+    @staticmethod
+    def finish(name):
+        Migration(key_name=name).put()
+
 class ImagePicker(db.Model):
     """ images selected by user """
 
+    # Migration finished by /_ah/cmd/reindex_image_pickers
+    REINDEX = 'reindex_image_pickers'
+
     added_on     = db.DateTimeProperty(auto_now_add=True)
     added_by     = db.UserProperty()
     report       = db.ReferenceProperty(Report)    
     cell         = db.StringProperty(required=True)
-    location     = db.TextProperty(required=True)
+    location     = GeometryProperty(required=True)
     sensor_dates = db.StringListProperty(required=True)
     start        = db.DateTimeProperty(required=True)
     end          = db.DateTimeProperty(required=True)
+    # all sensor_dates are modis ones, set on put
+    modis_only   = db.BooleanProperty()
 
 
     def as_dict(self):
@@ -900,7 +1641,7 @@ class ImagePicker(db.Model):
                 'year': self.year,
                 'month': self.month,
                 'day': self.day,
-                'Location': json.loads(self.location),
+                'Location': self.location.coordinates,
                 'compounddate': self.compounddate,
                 'added_on': timestamp(self.added_on),
                 'added_by': str(self.added_by.nickname())
@@ -918,22 +1659,21 @@ class ImagePicker(db.Model):
         if isinstance(end, types.IntType):
             end = datetime.fromtimestamp(end / 1e3)
             
-        if long_span:
-            q = ImagePicker.all().filter('start <=', start)
-        else:     
-            q = ImagePicker.all().filter('start =', start).filter('end =', end)
-
-        r = q.fetch(100)
+        def in_period(q):
+            if long_span:
+                # pickers of the months in the span, pickers start on the
+                # first day of the month
+                return q.filter('start >=', datetime(start.year, start.month, 1)).filter('start <=', end)
+            return q.filter('start =', start).filter('end =', end)
+
+        r = in_period(ImagePicker.all().filter('modis_only =', True)).fetch(100)
+        if not Migration.is_done(ImagePicker.REINDEX):
+            # pickers saved before modis_only existed don't have it so
+            # the filter skips them, until reindex_image_pickers ends
+            r.extend(p for p in in_period(ImagePicker.all())
+                     if p.modis_only is None and p.is_modis_only())
 
         if r:
-            list_remove = []
-            for i in range(len(r)):
-                for j in range(len(r[i].sensor_dates)):
-                    if "modis" not in r[i].sensor_dates[j]:
-                        list_remove.append(r[i])
-                        # r.remove(r[i])
-            for i in range(len(list_remove)):
-                r.remove(list_remove[i])
             return r
         else:
             return None
@@ -954,6 +1694,18 @@ class ImagePicker(db.Model):
         else:
             return None
     
+    @staticmethod
+    def selected_days(start, end, cell):
+        """ set of 'YYYY-MM-DD' days picked for cell in the period, one
+            query for all the days checked with is_day_selected
+        """
+        q = ImagePicker.all().filter('start =', start).filter('end =', end).filter('cell =', cell)
+        days = set()
+        for picker in q.fetch(1):
+            for sensor_date in picker.sensor_dates:
+                days.add(sensor_date.split('__')[-1])
+        return days
+
     @staticmethod
     def is_day_selected(day, start, end, cell):
         q = ImagePicker.all().filter('start =', start).filter('end =', end).filter('cell =', cell)
@@ -988,30 +1740,58 @@ class ImagePicker(db.Model):
         
     @staticmethod
     def list_by_period_date(start, end, tile):
-        q = ImagePicker.all().filter("cell =", tile).filter("start =", start).filter("end =", end)
-        r = q.fetch(1)
-        if r:
-            result = []
-            for i in range(len(r[0].sensor_dates)):
-                sensor, date = r[0].sensor_dates[i].split('__')
-                date = datetime.strptime(date, '%Y-%m-%d').date()
-                
-                if date < end and date > start:
-                    result.append({                                  
-                                   'sensor': sensor,
-                                   'cell': r[0].cell,
-                                   'year': date.year,
-                                   'month': date.month,
-                                   'day': date.day,
-                                   'Location': json.loads(r[0].location),
-                                   'compounddate': '%04d%02d' % (date.year, date.month),
-                                   'added_on': timestamp(r[0].added_on),
-                                   'added_by': str(r[0].added_by.nickname())})
-                
-                
-            return result
-        else:
-            return []
+        return ImagePicker.list_by_period_date_many(start, end, [tile])[0]
+
+    @staticmethod
+    def list_by_period_date_many(start, end, tiles):
+        """ images picked for the period with dates inside it, a list per
+            tile in the same order. One ImagePickerScene query for all
+            the tiles
+        """
+        by_tile = dict((t, []) for t in tiles)
+        if end is None:
+            return [by_tile[t] for t in tiles]
+        scenes = []
+        # IN queries accept up to 30 values
+        for i in range(0, len(tiles), 30):
+            q = ImagePickerScene.all().filter('start =', start).filter('end =', end)
+            q.filter('cell IN', list(tiles[i:i+30]))
+            q.filter('date >', start).filter('date <', end).order('date')
+            scenes.extend(q.fetch(1000))
+        parent_keys = list(set(s.parent_key() for s in scenes))
+        pickers = dict(zip(parent_keys, db.get(parent_keys)))
+        for s in scenes:
+            picker = pickers[s.parent_key()]
+            if picker is None:
+                continue
+            date = s.date
+            by_tile[s.cell].append({
+                           'sensor': s.sensor,
+                           'cell': s.cell,
+                           'year': date.year,
+                           'month': date.month,
+                           'day': date.day,
+                           'Location': picker.location.coordinates,
+                           'compounddate': '%04d%02d' % (date.year, date.month),
+                           'added_on': timestamp(picker.added_on),
+                           'added_by': str(picker.added_by.nickname())})
+        return [by_tile[t] for t in tiles]
+
+    def is_modis_only(self):
+        return all('modis' in sd for sd in self.sensor_dates)
+
+    def put(self):
+        self.modis_only = self.is_modis_only()
+        return super(ImagePicker, self).put()
+
+    def put_scenes(self, sensor_dates=None):
+        """ save an ImagePickerScene for each of sensor_dates, all the
+            picker ones by default
+        """
+        scenes = [ImagePickerScene.from_sensor_date(self, sd)
+                  for sd in (self.sensor_dates if sensor_dates is None else sensor_dates)]
+        db.put(scenes)
+        return scenes
         
      
 
@@ -1040,9 +1820,7 @@ class ImagePicker(db.Model):
         
         if r:
             for i in range(len(r)):
-                location = r[i].location
-                polygon = ast.literal_eval(location)
-                geometry = ee.Geometry.Polygon(polygon)
+                geometry = ee.Geometry.Polygon(r[i].location.coordinates)
 
                 days = []
                 for j in range(len(r[i].sensor_dates)):
@@ -1092,7 +1870,7 @@ class ImagePicker(db.Model):
                 sensor_dates.append("modis__" + year + '-' + str(int(month)).zfill(2) + '-' + day)  
             
             #image_picker = ImagePicker(sensor='MODIS', report=report, added_by= users.get_current_user(), cell=str(cell),  year=str(year), month=str(month), day=days.split(","), location=str(location), compounddate=str(compounddate))
-            image_picker = ImagePicker(report=report, added_by= users.get_current_user(), cell=str(cell),  location=str(location), sensor_dates=sensor_dates, start=date_start, end=date_end)
+            image_picker = ImagePicker(report=report, added_by= users.get_current_user(), cell=str(cell),  location=location, sensor_dates=sensor_dates, start=date_start, end=date_end)
             
             image_picker.save()
 
@@ -1102,13 +1880,17 @@ class ImagePicker(db.Model):
 
         try:
             if r:
-                
+                added = []
                 for index in range(len(self.sensor_dates)): 
                     if self.sensor_dates[index] not in r[0].sensor_dates:
                         r[0].sensor_dates.append(self.sensor_dates[index])               
+                        added.append(self.sensor_dates[index])
                 r[0].put()
+                r[0].put_scenes(added)
             else:
                 self.put()
+                self.put_scenes()
+            bump_graph_generation()
 
             return 'Images saved.'
         except:
@@ -1116,6 +1898,30 @@ class ImagePicker(db.Model):
 
 
 
+class ImagePickerScene(db.Model):
+    """ one sensor and date of an ImagePicker, child of it with the
+        sensor_dates entry as key name. Copies the picker cell and period
+        so pickers can be listed by date in queries
+    """
+
+    cell   = db.StringProperty(required=True)
+    sensor = db.StringProperty(required=True)
+    date   = db.DateProperty(required=True)
+    start  = db.DateTimeProperty(required=True)
+    end    = db.DateTimeProperty(required=True)
+
+    @staticmethod
+    def from_sensor_date(picker, sensor_date):
+        sensor, day = sensor_date.split('__')
+        return ImagePickerScene(parent=picker,
+                                key_name=sensor_date,
+                                cell=picker.cell,
+                                sensor=sensor,
+                                date=datetime.strptime(day, '%Y-%m-%d').date(),
+                                start=picker.start,
+                                end=picker.end)
+
+
 class Downscalling(db.Model):
     """ images selected by user """
 
@@ -1123,7 +1929,7 @@ class Downscalling(db.Model):
     added_by     = db.UserProperty()
     report       = db.ReferenceProperty(Report)
     cell         = db.StringProperty(required=True)
-    region       = db.TextProperty(required=True)
+    region       = GeometryProperty(required=True)
     compounddate = db.StringProperty(required=True)
     band         = db.IntegerProperty(required=True)
     model        = db.StringProperty(required=True)
@@ -1136,7 +1942,7 @@ class Downscalling(db.Model):
                 'id': str(self.key()),
                 'key': str(self.key()),
                 'cell': self.cell,
-                'region': json.loads(self.region),
+                'region': self.region.coordinates,
                 'compounddate': self.compounddate,
                 'band': self.band,
                 'model': self.model,
@@ -1167,9 +1973,7 @@ class Downscalling(db.Model):
         
         if r:
                 for i in range(len(r)):
-                    region = r[i].region
-                    polygon = ast.literal_eval(region)
-                    geometry = ee.Geometry.Polygon(polygon)
+                    geometry = ee.Geometry.Polygon(r[i].region.coordinates)
                     properties = {'Band': str(r[i].band),
                                   'Cell': r[i].cell,
                                   'Compounddate': str(r[i].compounddate),
@@ -1209,7 +2013,7 @@ class Downscalling(db.Model):
             downscalling = Downscalling(report=report,
                                         added_by= users.get_current_user(),
                                         cell=str(cell),
-                                        region=str(location),
+                                        region=location,
                                         compounddate=str(int(compounddate)),
                                         band= long(band),
                                         model=model,
@@ -1232,6 +2036,7 @@ class Downscalling(db.Model):
                 r[0].put()
             else:
                 self.put()
+            bump_graph_generation()
 
             return 'Values saved.'
         except:
@@ -1257,17 +2062,10 @@ class Baseline(db.Model):
     
     @property
     def image_picker(self):
-        result = []
         cell_name = str(self.cell.z) +'_'+ str(self.cell.x) +'_'+ str(self.cell.y)
-        tiles = Tile.find_by_cell_name(cell_name)
-        
-        for tile in tiles:
-            tile_name = tiles[tile]['name']
-            list_image_picker = ImagePicker.list_by_period_date(self.start, self.end, tile_name)
-            result.append(list_image_picker)            
-                
-            
-        return result
+        tiles = Tile.find_by_cell_name(cell_name) or {}
+        tile_names = [tiles[tile]['name'] for tile in tiles]
+        return ImagePicker.list_by_period_date_many(self.start, self.end, tile_names)
 
     def as_dict(self):
         cell_name = str(self.cell.z) +'_'+ str(self.cell.x) +'_'+ str(self.cell.y)
@@ -1452,16 +2250,10 @@ class TimeSeries(db.Model):
     
     @property
     def image_picker(self):
-        result = []      
         cell_name = str(self.cell.z) +'_'+ str(self.cell.x) +'_'+ str(self.cell.y)  
-        tiles = Tile.find_by_cell_name(cell_name)
-        
-        for tile in tiles:
-            tile_name = tiles[tile]['name']
-            list_image_picker = ImagePicker.list_by_period_date(self.start, self.end, tile_name)
-            result.append(list_image_picker)                            
-            
-        return result
+        tiles = Tile.find_by_cell_name(cell_name) or {}
+        tile_names = [tiles[tile]['name'] for tile in tiles]
+        return ImagePicker.list_by_period_date_many(self.start, self.end, tile_names)
 
     def as_dict(self):
         cell_name = str(self.cell.z) +'_'+ str(self.cell.x) +'_'+ str(self.cell.y)
@@ -0,0 +1,76 @@
+"""
+parallel.py
+
+Helpers to run blocking remote calls (Earth Engine, Fusion Tables)
+concurrently inside a request or a task. Threads always finish before
+fan_out returns.
+
+"""
+
+import logging
+import threading
+import time
+
+
+class TokenBucket(object):
+    """ rate limiter shared by threads, allows ``rate`` calls per second
+        with bursts of up to ``capacity`` calls
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """ block until a token is available """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+
+def fan_out(func, items, max_workers=4, bucket=None):
+    """ call func(item) for each item using up to max_workers threads.
+        Returns a list of (result, exception) tuples in items order, one
+        failed call does not stop the others
+    """
+    items = list(items)
+    results = [None]*len(items)
+    pending = iter(enumerate(items))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    i, item = pending.next()
+                except StopIteration:
+                    return
+            if bucket:
+                bucket.consume()
+            try:
+                results[i] = (func(item), None)
+            except Exception, e:
+                logging.exception("call failed for %r" % (item,))
+                results[i] = (None, e)
+
+    workers = min(max_workers, len(items))
+    if workers <= 1:
+        worker()
+        return results
+    threads = [threading.Thread(target=worker) for _ in xrange(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
@@ -7,22 +7,32 @@ Classes for describing different report formats.
 
 import logging
 import csv
+import uuid
 from application import settings
+from google.appengine.ext import blobstore
 from google.appengine.ext import deferred
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 from ft import FT
+from gcs import GCSWriter
 from flask import Response, abort, request
 from StringIO import StringIO
-from models import FustionTablesNames, StatsStore
+from models import FustionTablesNames, ZoneStats
 
 
 class ReportType(object):
 
     zone = None
+    mimetype = None
+    extension = None
+
+    def __init__(self):
+        # per request buffer, emptied each time a row is written out
+        self.f = StringIO()
+        # zone names by table, looked up once per table
+        self._names = {}
 
     def init(self, zone):
-        self.f.truncate(0)
         self.zone = zone
    
     def set_zone(self):
@@ -40,34 +50,61 @@ class ReportType(object):
     def value(self):
         raise NotImplementedError
 
+    def _headers(self, file_name):
+        return {
+            "Content-Disposition": "attachment; filename=\"" + file_name +
+            "." + self.extension + "\""
+        }
+
     def response(self, file_name):
-        raise NotImplementedError
+        return Response(self.value(),
+            headers=self._headers(file_name),
+            mimetype=self.mimetype)
+
+    def _take(self):
+        """ return buffered output and empty the buffer """
+        data = self.f.getvalue()
+        self.f.seek(0)
+        self.f.truncate()
+        return data
+
+    def file_response(self, file_name, rows):
+        """ write the report for ``rows``, an iterable of write_row
+            arguments, to a Cloud Storage file a row at a time and return
+            a response App Engine serves from it, so the whole report is
+            never held in memory
+        """
+        name = '%s%s/%s.%s' % (settings.REPORTS_GCS_PREFIX, uuid.uuid4().hex, file_name, self.extension)
+        out = GCSWriter(name, self.mimetype, settings.REPORTS_GCS_BUCKET)
+        self.write_header()
+        out.write(self._take())
+        for row in rows:
+            self.write_row(*row)
+            out.write(self._take())
+        self.write_footer()
+        out.write(self._take())
+        out.close()
+        response = Response('',
+            headers=self._headers(file_name),
+            mimetype=self.mimetype)
+        response.headers[blobstore.BLOB_KEY_HEADER] = blobstore.create_gs_key(out.gs_path)
+        return response
 
     def get_stats(self, report, table):
         report_id = str(report.key())
-        st = StatsStore.get_for_report(report_id)
-        if not st:
-           logging.error("no cached stats for %s" % report_id)
-           abort(404)
-
         if self.zone:
-            stats = st.table_accum(table, self.zone)
-            if not stats:
-                logging.error("no stats for %s" % report_id)
-                abort(404)
+            stats = ZoneStats.table_accum(report_id, table, self.zone)
         else:
-            stats = st.for_table(table)
-            if not stats:
-                logging.error("no stats for %s" % report_id)
-                abort(404)
+            stats = ZoneStats.for_table(report_id, table)
+        if not stats:
+            logging.error("no stats for %s" % report_id)
+            abort(404)
         return stats
 
     def get_polygon_name(self, table, id):
-            all_table_names = FustionTablesNames.all()
-            filtered_table_names = all_table_names.filter('table_id =', table)
-            table_names=filtered_table_names.fetch(1)[0].as_dict()
-            name = table_names.get(id, id)
-            return name
+        if table not in self._names:
+            self._names[table] = FustionTablesNames.names(table)
+        return self._names[table].get(id, id)
     
     @staticmethod
     def factory(format):
@@ -80,8 +117,12 @@ class ReportType(object):
 
 class CSVReportType(ReportType):
 
-    f = StringIO()
-    csv_file = csv.writer(f)
+    mimetype = 'text/csv'
+    extension = 'csv'
+
+    def __init__(self):
+        super(CSVReportType, self).__init__()
+        self.csv_file = csv.writer(self.f)
 
     def write_header(self):
         if self.zone:
@@ -118,19 +159,10 @@ class CSVReportType(ReportType):
     def value(self):
         return self.f.getvalue()
 
-    def response(self, file_name):
-        result = self.value()
-        self.f.truncate(0)
-        return Response(result, 
-            headers={
-                "Content-Disposition": "attachment; filename=\"" + file_name + 
-                ".csv\""
-            },
-            mimetype='text/csv')
-
 class KMLReportType(ReportType):
 
-    f = StringIO()
+    mimetype = 'text/kml'
+    extension = 'kml'
 
     def write_header(self):
         self.f.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>")
@@ -168,16 +200,6 @@ class KMLReportType(ReportType):
     def value(self):
         return self.f.getvalue()
 
-    def response(self, file_name):
-        result = self.value()
-        self.f.truncate(0)
-        return Response(result, 
-            headers={
-                "Content-Disposition": "attachment; filename=\"" + file_name + 
-                ".kml\""
-            },
-            mimetype='text/kml')
-
     def kml(self, table, row_id):
         cl = FT(settings.FT_CONSUMER_KEY,
                 settings.FT_CONSUMER_SECRET,
@@ -32,6 +32,7 @@ from google.appengine.api import users
 from google.appengine.ext.db import Key
 
 from application import settings
+from application.cache import get_or_compute
 from application.constants import amazon_bounds
 from application.ee_bridge import NDFI, EELandsat
 from application.models import Report, Cell, Area, Note, CELL_BLACK_LIST, User
@@ -50,16 +51,15 @@ class NDFIMapApi(Resource):
         return report_id + "_ndfi_" + sensor
 
     def list(self, report_id, sensor):
-        cache_key = self._cache_key(report_id, sensor)
-        data = memcache.get(cache_key)
-        if not data:
+        def compute():
             r = Report.get(Key(report_id))
             ndfi = NDFI(r.comparation_range(), r.range())
             logging.info('((((( Report Id: ' + str(report_id) +', Sensor:'+ str(sensor) +' )))))')
-            data = ndfi.mapid2(r.base_map(), sensor)
-            if not data:
-                abort(404)
-            memcache.add(key=cache_key, value=data, time=3600)
+            return ndfi.mapid2(r.base_map(), sensor) or None
+
+        data = get_or_compute(self._cache_key(report_id, sensor), compute, 3600)
+        if not data:
+            abort(404)
         return jsonify(data)
 
 
@@ -134,15 +134,16 @@ class CellAPI(Resource):
 
     def list(self, report_id, operation):
         r = Report.get(Key(report_id))
-        cell = Cell.get_or_default(r, 0, 0, 0)
-        return self._as_json([x.as_dict() for x in iter(cell.children()) if not self.is_in_backlist(x)])
+        cell = Cell.get_or_default(r, operation, 0, 0, 0)
+        cells = [x for x in cell.children() if not self.is_in_backlist(x)]
+        return self._as_json(Cell.as_dict_many(cells))
 
     def children(self, report_id, operation, id):
         r = Report.get(Key(report_id))
         z, x, y = Cell.cell_id(id)
         cell = Cell.get_or_default(r, operation, x, y, z)
-        cells = cell.children()
-        return self._as_json([x.as_dict() for x in cells if not self.is_in_backlist(x)])
+        cells = [x for x in cell.children() if not self.is_in_backlist(x)]
+        return self._as_json(Cell.as_dict_many(cells))
 
     def get(self, report_id, operation, id):
         r = Report.get(Key(report_id))
@@ -164,9 +165,9 @@ class CellAPI(Resource):
         cell.map_two_layer_status = str(data['map_two_layer_status'])
         cell.map_three_layer_status = str(data['map_three_layer_status'])
         cell.map_four_layer_status = str(data['map_four_layer_status'])
-        cell.done = data['done']
         cell.last_change_by = users.get_current_user()
-        cell.put()
+        # done is saved with the counters of the parent and the report
+        cell.save_done(data['done'], put=True)
 
         return Response(cell.as_json(), mimetype='application/json')
 
@@ -256,14 +257,16 @@ class PolygonAPI(Resource):
         r = Report.get(Key(report_id))
         z, x, y = Cell.cell_id(cell_pos)
         cell = Cell.get_or_create(r, operation, x, y, z)
+        # put the cell before saving the area, a later put would
+        # overwrite the polygon counter updated by Area.save
+        cell.last_change_by = users.get_current_user()
+        cell.put()
         data = json.loads(request.data)
         a = Area(geo=json.dumps(data['paths']),
             type=data['type'],
             added_by = users.get_current_user(),
             cell=cell)
         a.save();
-        cell.last_change_by = users.get_current_user()
-        cell.put()
         return Response(a.as_json(), mimetype='application/json')
 
     def update(self, report_id, cell_pos, id):
@@ -291,7 +294,7 @@ class NoteAPI(Resource):
     def list(self, report_id, cell_pos):
         r = Report.get(Key(report_id))
         z, x, y = Cell.cell_id(cell_pos)
-        cell = Cell.get_cell(r, x, y, z)
+        cell = Cell.get_cell(r, 'null', x, y, z)
         notes = []
         if cell:
             return self._as_json([x.as_dict() for x in cell.note_set])
@@ -301,7 +304,7 @@ class NoteAPI(Resource):
     def create(self, report_id, cell_pos):
         r = Report.get(Key(report_id))
         z, x, y = Cell.cell_id(cell_pos)
-        cell = Cell.get_or_create(r, x, y, z)
+        cell = Cell.get_or_create(r, 'null', x, y, z)
         data = json.loads(request.data)
         if 'msg' not in data:
             abort(400)
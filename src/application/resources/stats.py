@@ -51,6 +51,24 @@ class RegionStatsAPI(Resource):
             memcache.set(cache_key, data)
         return Response(data, mimetype='application/json')
 
+    def batch(self):
+        """ stats for several reports and tables at once
+
+            ?reports=<report_id>,...&tables=<table_id>,...
+        """
+        try:
+            report_ids = map(int, request.args.get('reports', '').split(','))
+            table_ids = map(int, request.args.get('tables', '').split(','))
+        except ValueError:
+            logging.error("bad format for report or table ids")
+            abort(400)
+        reports = [Report.get_by_id(x) for x in report_ids]
+        if not all(reports):
+            logging.error("can't find some report")
+            abort(404)
+        stats = self.ee.get_stats_many([(str(r.key().id()), r.assetid) for r in reports], table_ids)
+        return self._as_json(stats)
+
     def get(self, report_id, id):
         r = Report.get(Key(report_id))
         s = self.stats_for(str(r.key().id()), r.assetid, int(id))
@@ -45,6 +45,49 @@ else:
         FT_TABLE = 'SAD EE Polygons'
         FT_TABLE_ID = '2949980'
 
+# Region stats are computed for several tables at once, see
+# commands.update_report_stats. Calls per second are limited to avoid
+# Fusion Tables and Earth Engine quota errors.
+STATS_MAX_WORKERS = 3
+STATS_CALLS_PER_SECOND = 0.25
+
+# Area changes are sent to fusion tables in batches of FT_SYNC_BATCH,
+# changes made in FT_SYNC_DELAY seconds are sent together (see AreaSync)
+FT_SYNC_BATCH = 50
+FT_SYNC_DELAY = 30
+# drains run in this queue, one at a time (see queue.yaml), and an
+# entry is moved aside after FT_SYNC_MAX_FAILURES failed sends
+FT_SYNC_QUEUE = 'ftsync'
+FT_SYNC_MAX_FAILURES = 5
+
+# stats reports are written to this Cloud Storage bucket, the default
+# app bucket if None, under REPORTS_GCS_PREFIX. Add a lifecycle rule to
+# the bucket to delete them after a day
+REPORTS_GCS_BUCKET = None
+REPORTS_GCS_PREFIX = 'reports/'
+
+# Seconds Earth Engine map ids are cached, must be lower than the map
+# token lifetime, see application/cache.py
+MAPID_CACHE_TIME = 60*60
+
+# Threads used to request independent Earth Engine map ids and images
+# at once, see ee_bridge.map_ids
+EE_MAX_WORKERS = 6
+
+# Seconds the Landsat scene id of a (sensor, tile, date) is cached, see
+# EELandsat.find_scene_ids
+SCENE_CACHE_TIME = 24*60*60
+
+# MODIS picker thumbnails are requested concurrently and their ids are
+# cached like map ids, see cache.thumb_ids
+THUMB_MAX_WORKERS = 8
+THUMB_CACHE_TIME = 60*60
+
+# Earth Engine map tiles proxied by /ee/tiles are cached in memcache, in
+# an in process LRU of at most TILE_CACHE_BYTES and by the browsers
+TILE_CACHE_BYTES = 16*1024*1024
+TILE_CACHE_TIME = 60*60
+
 # Initialize the EE API.
 EE_TILE_SERVER = EE_API_URL + '/map/'
 ee.data.DEFAULT_DEADLINE = 60 * 20
@@ -0,0 +1,162 @@
+"""
+spatial.py
+
+In process spatial index for polygon footprints.
+
+Polygons are coordinate lists like the ones given to ee.Geometry.Polygon,
+a list of rings being the first one the outer ring. Only outer rings are
+used, tile and cell footprints don't have holes. Tests are planar in the
+coordinate space of the polygons.
+
+The index is an R-tree packed with Sort-Tile-Recursive, it's built once
+from all the items and not updated, rebuild it when they change.
+
+"""
+
+import math
+
+NODE_CAPACITY = 16
+
+
+def bbox(polygon):
+    """ (minx, miny, maxx, maxy) of the outer ring """
+    ring = polygon[0]
+    xs = [p[0] for p in ring]
+    ys = [p[1] for p in ring]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def bbox_intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def _union(boxes):
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+def _cross(o, a, b):
+    return (a[0] - o[0])*(b[1] - o[1]) - (a[1] - o[1])*(b[0] - o[0])
+
+def _on_segment(p, q, r):
+    """ q lies in the box of segment pr """
+    return (min(p[0], r[0]) <= q[0] <= max(p[0], r[0]) and
+            min(p[1], r[1]) <= q[1] <= max(p[1], r[1]))
+
+def segments_intersect(p1, p2, q1, q2):
+    d1 = _cross(q1, q2, p1)
+    d2 = _cross(q1, q2, p2)
+    d3 = _cross(p1, p2, q1)
+    d4 = _cross(p1, p2, q2)
+    if ((d1 > 0) != (d2 > 0) and d1 != 0 and d2 != 0 and
+        (d3 > 0) != (d4 > 0) and d3 != 0 and d4 != 0):
+        return True
+    # collinear and touching cases
+    return ((d1 == 0 and _on_segment(q1, p1, q2)) or
+            (d2 == 0 and _on_segment(q1, p2, q2)) or
+            (d3 == 0 and _on_segment(p1, q1, p2)) or
+            (d4 == 0 and _on_segment(p1, q2, p2)))
+
+def point_in_ring(point, ring):
+    """ ray casting, points in the boundary may be reported either way """
+    x, y = point[0], point[1]
+    inside = False
+    j = len(ring) - 1
+    for i in xrange(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > y) != (yj > y) and x < (xj - xi)*(y - yi)/float(yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def _edges(ring):
+    n = len(ring)
+    return [(ring[i], ring[(i + 1) % n]) for i in xrange(n)]
+
+def polygons_intersect(a, b, box_a=None, box_b=None):
+    """ true if the outer rings of a and b share any point """
+    box_a = box_a or bbox(a)
+    box_b = box_b or bbox(b)
+    if not bbox_intersects(box_a, box_b):
+        return False
+    ring_a, ring_b = a[0], b[0]
+    # one inside the other
+    if point_in_ring(ring_a[0], ring_b) or point_in_ring(ring_b[0], ring_a):
+        return True
+    edges_b = [e for e in _edges(ring_b) if bbox_intersects(box_a, _segment_box(e))]
+    for p1, p2 in _edges(ring_a):
+        box = _segment_box((p1, p2))
+        if not bbox_intersects(box, box_b):
+            continue
+        for q1, q2 in edges_b:
+            if segments_intersect(p1, p2, q1, q2):
+                return True
+    return False
+
+def _segment_box(e):
+    (x1, y1), (x2, y2) = e[0][:2], e[1][:2]
+    return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+
+class STRTree(object):
+    """ static R-tree over (key, polygon) items """
+
+    def __init__(self, items, capacity=NODE_CAPACITY):
+        self.capacity = capacity
+        self.polygons = {}
+        leaves = []
+        for key, polygon in items:
+            box = bbox(polygon)
+            self.polygons[key] = (polygon, box)
+            leaves.append((box, key))
+        self.size = len(leaves)
+        self.root = None
+        if not leaves:
+            return
+        # each level is a list of (box, children or key)
+        level = self._pack(leaves)
+        while len(level) > 1:
+            level = self._pack(level)
+        self.root = level[0]
+
+    def _pack(self, entries):
+        """ group entries in nodes sorting by x in slices and by y inside
+            each slice
+        """
+        n_nodes = int(math.ceil(len(entries)/float(self.capacity)))
+        n_slices = int(math.ceil(math.sqrt(n_nodes)))
+        center_x = lambda e: e[0][0] + e[0][2]
+        center_y = lambda e: e[0][1] + e[0][3]
+        entries = sorted(entries, key=center_x)
+        per_slice = n_slices*self.capacity
+        nodes = []
+        for s in xrange(0, len(entries), per_slice):
+            vertical = sorted(entries[s:s + per_slice], key=center_y)
+            for i in xrange(0, len(vertical), self.capacity):
+                children = vertical[i:i + self.capacity]
+                nodes.append((_union([c[0] for c in children]), children))
+        return nodes
+
+    def query(self, box):
+        """ keys whose bounding box intersects box """
+        result = []
+        if self.root is None:
+            return result
+        stack = [self.root]
+        while stack:
+            node_box, children = stack.pop()
+            if not bbox_intersects(node_box, box):
+                continue
+            if isinstance(children, list):
+                stack.extend(children)
+            else:
+                result.append(children)
+        return result
+
+    def intersecting(self, polygon):
+        """ keys of the polygons which intersect polygon """
+        box = bbox(polygon)
+        result = []
+        for key in self.query(box):
+            other, other_box = self.polygons[key]
+            if polygons_intersect(polygon, other, box, other_box):
+                result.append(key)
+        return result
@@ -1,6 +1,7 @@
 # encoding: utf-8
 
 import datetime
+import hashlib
 import re
 from shutil import copyfile
 import sys
@@ -14,6 +15,7 @@ from google.appengine.api import urlfetch
 
 from app import app
 from application import settings
+from application.cache import get_or_compute, ByteLRU
 from application.ee_bridge import EELandsat, SMA, NDFI, get_modis_thumbnails_list, get_modis_location, \
     create_baseline, create_time_series, create_tile_baseline, create_tile_timeseries
 from application.models import Baseline, Tile, TimeSeries, CellGrid
@@ -104,13 +106,8 @@ def start():
 @app.route('/analysis')
 @login_required
 def home():
-    maps = memcache.get('default_maps')
-
-    if maps:
-        maps = json.loads(maps)
-    else:
-        maps = default_maps()
-        memcache.add(key='default_maps', value=json.dumps(maps), time=60*10)
+    maps = json.loads(get_or_compute('default_maps',
+                                     lambda: json.dumps(default_maps()), 60*10))
 
     # send only the active report
     reports = json.dumps([Report.current().as_dict()])
@@ -177,15 +174,44 @@ def tiles(tile_path):
 EARTH_ENGINE_TILE_SERVER = settings.EE_TILE_SERVER
 
 
+# (content type, content) of the last proxied tiles
+_tiles = ByteLRU(settings.TILE_CACHE_BYTES)
+
 @app.route('/ee/tiles/<path:tile_path>')
 def earth_engine_tile_proyx(tile_path):
     token = request.args.get('token', '')
     if not token:
         abort(401)
-    result = urlfetch.fetch(EARTH_ENGINE_TILE_SERVER + tile_path + '?token=' + token, deadline=10)
-
-    response = make_response(result.content)
-    response.headers['Content-Type'] = result.headers['Content-Type']
+    # a map id always renders the same tiles so the path and the token
+    # identify the content. The token is part of the key so only the
+    # requests EE accepted with it are served from the cache
+    key = hashlib.sha1(tile_path + '?token=' + token).hexdigest()
+    tile = _tiles.get(key)
+    if tile is None:
+        failed = []
+        def fetch():
+            result = urlfetch.fetch(EARTH_ENGINE_TILE_SERVER + tile_path + '?token=' + token, deadline=10)
+            if result.status_code != 200:
+                failed.append(result)
+                return None
+            return (result.headers['Content-Type'], result.content)
+
+        # concurrent requests for the same tile wait for the first one
+        tile = get_or_compute('tile:' + key, fetch, settings.TILE_CACHE_TIME, wait=0.05, timeout=10)
+        if tile is None:
+            result = failed[-1]
+            response = make_response(result.content, result.status_code)
+            response.headers['Content-Type'] = result.headers.get('Content-Type', 'text/plain')
+            return response
+        _tiles.set(key, tile, len(tile[1]))
+
+    if request.if_none_match.contains(key):
+        response = make_response('', 304)
+    else:
+        response = make_response(tile[1])
+        response.headers['Content-Type'] = tile[0]
+    response.headers['Cache-Control'] = 'public, max-age=%d' % settings.TILE_CACHE_TIME
+    response.set_etag(key)
     return response
 
 
@@ -632,7 +658,7 @@ def imagepicker_tile():
             image_picker = ImagePicker(report=report,
                                        added_by=users.get_current_user(),
                                        cell=str(key.replace("_", "/")),
-                                       location=str(sensor_date[key]['location']),
+                                       location=sensor_date[key]['location'],
                                        sensor_dates=sensor_date[key]['sensor_date'],
                                        start=date_start,
                                        end=date_end)
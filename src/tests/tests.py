@@ -10,11 +10,19 @@ import tempfile
 
 from google.appengine.ext import testbed
 from google.appengine.ext import db
+from google.appengine.api import memcache
 from google.appengine.api import users
 
 from application.app import app
 from application.models import Area, Note, Cell, Report, User
 from application import models
+from application import grid
+from application import kml
+from application import settings
+from application import spatial
+from application.cache import ByteLRU
+from application.constants import amazon_bounds
+from application.mercator import Mercator
 from application.resources.report import CellAPI
 from application.time_utils import timestamp
 
@@ -45,6 +53,198 @@ class CellTest(unittest.TestCase):
     def test_parent_id(self):
         self.assertEquals('1_2_2', self.cell.parent_id)
 
+    def test_bounds(self):
+        ne, sw = self.cell.bounds(amazon_bounds)
+        # bounds computed by hand with scalar mercator
+        righttop = Mercator.project(*amazon_bounds[0])
+        leftbottom = Mercator.project(*amazon_bounds[1])
+        sx = (righttop[0] - leftbottom[0])/25
+        sy = (leftbottom[1] - righttop[1])/25
+        expected_ne = Mercator.unproject(12*sx + leftbottom[0], 11*sy + righttop[1])
+        self.assertAlmostEquals(expected_ne[0], ne[0])
+        self.assertAlmostEquals(expected_ne[1], ne[1])
+        # point to cell is the inverse
+        center = ((ne[0] + sw[0])/2, (ne[1] + sw[1])/2)
+        self.assertEquals((11, 11), grid.cell_at(amazon_bounds, 2, center[0], center[1], models.SPLITS))
+        self.assertEquals(None, grid.cell_at(amazon_bounds, 2, 10.0, 0.0, models.SPLITS))
+
+    def test_key_name(self):
+        name = Cell.key_name_for(self.r, 'sad', 11, 11, 2)
+        self.assertEquals(name, self.cell.key().name())
+        self.assertEquals(self.cell.key(), Cell.get_cell(self.r, 'null', 11, 11, 2).key())
+        Cell.flush_parents()
+        parent = self.cell.get_parent()
+        self.assertTrue(parent.is_saved())
+        children = [c for c in parent.children() if c.is_saved()]
+        self.assertEquals(1, len(children))
+        self.assertEquals(self.cell.key(), children[0].key())
+
+class KMLTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        paths = [[[-11.5, -61.5], [-11.0, -61.5], [-11.0, -60.5]], [[-11.2, -61.2], [-11.1, -61.1], [-11.1, -61.2]]]
+        self.assertEquals([paths], kml.kml_to_paths(kml.path_to_kml(paths)))
+        multi = kml.multipolygon_to_kml([paths, paths[:1]])
+        self.assertTrue(multi.startswith('<MultiGeometry>'))
+        self.assertEquals([paths, paths[:1]], kml.kml_to_paths(multi))
+
+    def test_precision(self):
+        self.assertEquals([[[[-11.12, -61.99]]]],
+                          kml.kml_to_paths(kml.path_to_kml([[[-11.1234, -61.987]]], 2)))
+
+class GeometryTest(unittest.TestCase):
+
+    def test_old_text(self):
+        t = models.Tile(sensor='LANDSAT', name='231/67', cells=['2_1_1'], geo=str([[(-61.5, -11.5), (-61.0, -11.5), (-61.0, -11.0)]]))
+        t.put()
+        geo = models.Tile.get(t.key()).geo
+        self.assertFalse(geo.is_compact())
+        self.assertEquals([[[-61.5, -11.5], [-61.0, -11.5], [-61.0, -11.0]]], json.loads(geo.compact()))
+        self.assertEquals((-61.5, -11.5), geo.coordinates[0][0])
+
+    def test_coordinates(self):
+        paths = [[[-11.5, -61.5], [-11.0, -61.5], [-11.0, -60.5]]]
+        t = models.Tile(sensor='LANDSAT', name='231/67', cells=['2_1_1'], geo=paths)
+        t.put()
+        geo = models.Tile.get(t.key()).geo
+        self.assertTrue(geo.is_compact())
+        self.assertEquals(paths, geo.coordinates)
+
+class GenerationTest(unittest.TestCase):
+
+    def test_evicted(self):
+        key = 'test_generation'
+        models.new_generation(key)
+        seen = models.current_generation(key)
+        self.assertEquals(seen, models.current_generation(key))
+        models.new_generation(key)
+        self.assertNotEquals(seen, models.current_generation(key))
+        seen = models.current_generation(key)
+        memcache.delete(key)
+        self.assertNotEquals(seen, models.current_generation(key))
+
+class SpatialTest(unittest.TestCase):
+
+    def square(self, x, y, size):
+        return [[[x, y], [x + size, y], [x + size, y + size], [x, y + size]]]
+
+    def test_intersecting(self):
+        items = [('%d_%d' % (i, j), self.square(i, j, 1.2)) for i in range(10) for j in range(10)]
+        index = spatial.STRTree(items)
+        self.assertEquals(['5_5'], index.intersecting(self.square(5.5, 5.5, 0.2)))
+        self.assertEquals(['4_4', '4_5', '5_4', '5_5'], sorted(index.intersecting(self.square(5.1, 5.1, 0.05))))
+        self.assertEquals([], index.intersecting(self.square(-5, -5, 1)))
+        # edges crossing without vertices inside
+        self.assertTrue(spatial.polygons_intersect([[[0, 0], [4, 0], [4, 1], [0, 1]]], [[[1, -1], [2, -1], [1.5, 3]]]))
+
+    def test_empty(self):
+        index = spatial.STRTree([])
+        self.assertEquals(None, index.root)
+        self.assertEquals([], index.query((0, 0, 1, 1)))
+        self.assertEquals([], index.intersecting(self.square(0, 0, 1)))
+
+class TileMembershipTest(unittest.TestCase):
+
+    def setUp(self):
+        for x in models.Tile.all():
+            x.delete()
+        for x in models.CellGrid.all():
+            x.delete()
+
+    def square(self, x, y, size):
+        return [[[x, y], [x + size, y], [x + size, y + size], [x, y + size]]]
+
+    def test_covers(self):
+        models.Tile(sensor='landsat', name='231/66', cells=['2_1_1'], geo=self.square(0, 0, 1)).save()
+        models.Tile(sensor='landsat', name='231/67', cells=['2_1_1'], geo=self.square(5, 5, 1)).save()
+        # without grid every listed tile covers the cell
+        self.assertEquals(2, len(models.Tile.find_by_cell_name('2_1_1')))
+        grid = models.CellGrid(name='2_1_1', geo=self.square(0.5, 0.5, 1))
+        grid.save()
+        self.assertEquals(['231/66'], [t.name for t in grid.tiles])
+        self.assertEquals(['2_1_1'], models.Tile.find_cells_by_tile_name('231/66'))
+        self.assertEquals([], models.Tile.find_cells_by_tile_name('231/67'))
+        # reading doesn't touch the candidates
+        self.assertEquals(['2_1_1'], models.Tile.all().filter('name =', '231/67').get().cells)
+
+    def test_not_migrated(self):
+        # saved before covers existed
+        models.Tile(sensor='landsat', name='231/66', cells=['2_1_1'], geo=self.square(0, 0, 1)).put()
+        models.Tile(sensor='landsat', name='231/67', cells=['2_1_1'], geo=self.square(5, 5, 1)).put()
+        models.CellGrid(name='2_1_1', geo=self.square(0.5, 0.5, 1)).put()
+        models.Tile.invalidate_snapshot()
+        self.assertEquals(['231/66'], [t.name for t in models.CellGrid.find_by_name('2_1_1').tiles])
+        self.assertFalse(models.Tile.all().filter('name =', '231/66').get().covers_updated)
+
+class ImagePickerTest(unittest.TestCase):
+
+    def test_list_by_period_date_many(self):
+        start, end = datetime(2011, 2, 1), datetime(2011, 2, 28)
+        for tile, dates in (('231/66', ['landsat5__2011-02-10', 'landsat5__2011-03-01']),
+                            ('231/67', ['landsat7__2011-02-05'])):
+            models.ImagePicker(added_by=users.User('test@gmail.com'), cell=tile, location=[[[0, 0], [1, 0], [1, 1]]],
+                               sensor_dates=dates, start=start, end=end).save()
+        models.ImagePicker(added_by=users.User('test@gmail.com'), cell='231/67', location=[[[0, 0], [1, 0], [1, 1]]],
+                           sensor_dates=['landsat7__2011-02-15'], start=start, end=end).save()
+        result = models.ImagePicker.list_by_period_date_many(start, end, ['231/67', '231/66', '231/68'])
+        self.assertEquals([[5, 15], [10], []], [[x['day'] for x in r] for r in result])
+        self.assertEquals('landsat5', result[1][0]['sensor'])
+
+    def test_find_by_period(self):
+        for x in models.ImagePicker.all():
+            x.delete()
+        for x in models.Migration.all():
+            x.delete()
+        models._migrations_done.clear()
+        def picker(cell, month, dates):
+            start, end = datetime(2011, month, 1), datetime(2011, month + 1, 1)
+            models.ImagePicker(added_by=users.User('test@gmail.com'), cell=cell, location=[[[0, 0], [1, 0], [1, 1]]],
+                               sensor_dates=dates, start=start, end=end).save()
+        picker('h12v09', 2, ['modis__2011-02-10', 'modis__2011-02-11'])
+        picker('h12v10', 2, ['modis__2011-02-10', 'landsat5__2011-02-11', 'landsat5__2011-02-12'])
+        picker('h12v09', 4, ['modis__2011-04-10'])
+        picker('h12v09', 6, ['modis__2011-06-10'])
+        found = models.ImagePicker.find_by_period(datetime(2011, 2, 1), datetime(2011, 3, 1))
+        self.assertEquals(['h12v09'], [p.cell for p in found])
+        found = models.ImagePicker.find_by_period(datetime(2011, 2, 15), datetime(2011, 5, 1), True)
+        self.assertEquals([2, 4], sorted(p.start.month for p in found))
+        # saved before modis_only existed
+        old = models.ImagePicker.all().filter('start =', datetime(2011, 6, 1)).get()
+        old.modis_only = None
+        db.put(old)
+        found = models.ImagePicker.find_by_period(datetime(2011, 6, 1), datetime(2011, 7, 1))
+        self.assertEquals(['h12v09'], [p.cell for p in found])
+        # the reindex sets it
+        models.Migration.finish(models.ImagePicker.REINDEX)
+        self.assertEquals(None, models.ImagePicker.find_by_period(datetime(2011, 6, 1), datetime(2011, 7, 1)))
+
+class ByteLRUTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = ByteLRU(10)
+        lru.set('a', 'tile a', 4)
+        lru.set('b', 'tile b', 4)
+        self.assertEquals('tile a', lru.get('a'))
+        lru.set('c', 'tile c', 4)
+        self.assertEquals(None, lru.get('b'))
+        self.assertEquals('tile a', lru.get('a'))
+        self.assertEquals(8, lru.bytes)
+        # bigger than the cache is not stored
+        lru.set('d', 'tile d', 11)
+        self.assertEquals(None, lru.get('d'))
+
+class ZoneStatsTest(unittest.TestCase):
+
+    def test_save_report(self):
+        stats = {'a': {'table': 1, 'id': 10, 'def': 1.0, 'deg': 2.0},
+                 'b': {'table': 1, 'id': 11, 'def': 3.0, 'deg': 0.5}}
+        models.ZoneStats.save_report('r1', stats)
+        models.ZoneStats.save_report('r2', stats)
+        del stats['b']
+        models.ZoneStats.save_report('r1', stats)
+        self.assertEquals(['10'], [x['id'] for x in models.ZoneStats.for_table('r1', 1)])
+        self.assertEquals(2, len(models.ZoneStats.for_table('r2', 1)))
+
 class NotesApiTest(unittest.TestCase, GoogleAuthMixin):
     def setUp(self):
         app.config['TESTING'] = True
@@ -197,6 +397,45 @@ class CellApi(unittest.TestCase, GoogleAuthMixin):
         self.assertAlmostEquals(0, cell['ndfi_low'])
         self.assertAlmostEquals(1.0, cell['ndfi_high'])
 
+    def test_children_counts(self):
+        c = Cell(x=0, y=0, z=2, report=self.r, ndfi_high=1.0, ndfi_low=0.0)
+        c.put()
+        c.save_done(True)
+        Note(msg='test msg', added_by=users.get_current_user(), cell=c).save()
+        Area(geo='[]', added_by=users.get_current_user(), type=1, cell=c).save()
+        rv = self.app.get('/api/v0/report/' + str(self.r.key()) + '/operation/sad/cell/1_0_0/children')
+        self.assertEquals(200, rv.status_code)
+        js = json.loads(rv.data)
+        cell = [x for x in js if x['x'] == 0 and x['y'] == 0][0]
+        self.assertEquals(1, cell['note_count'])
+        self.assertEquals(1, cell['polygon_count'])
+        rv = self.app.get('/api/v0/report/' + str(self.r.key()) + '/operation/sad/cell/0_0_0/children')
+        js = json.loads(rv.data)
+        cell = [x for x in js if x['x'] == 0 and x['y'] == 0][0]
+        self.assertEquals(1, cell['children_done'])
+        self.assertEquals(1, Report.get(self.r.key()).cells_finished)
+
+    def test_put_keeps_counters(self):
+        c = Cell(x=0, y=0, z=2, report=self.r, ndfi_high=1.0, ndfi_low=0.0)
+        c.put()
+        stale = Cell.get(c.key())
+        Note(msg='test msg', added_by=users.get_current_user(), cell=c).save()
+        c.save_done(True)
+        stale.ndfi_low = 0.5
+        stale.put()
+        Cell.put_many([stale])
+        stored = Cell.get(c.key())
+        self.assertEquals(1, stored.note_count)
+        self.assertTrue(stored.done)
+        self.assertAlmostEquals(0.5, stored.ndfi_low)
+        # saved with the instance fields
+        stale.ndfi_high = 0.7
+        stale.save_done(False, put=True)
+        stored = Cell.get(c.key())
+        self.assertFalse(stored.done)
+        self.assertAlmostEquals(0.7, stored.ndfi_high)
+        self.assertEquals(0, Report.get(self.r.key()).cells_finished)
+
     def test_update_cell_2_0_1(self):
         rv = self.app.put('/api/v0/report/' + str(self.r.key())+'/cell/2_1_3',
             data='''{
@@ -260,6 +499,157 @@ class FTTest(unittest.TestCase):
         self.area.delete()
         self.area.delete_fusion_tables()
 
+class FakeFT(object):
+    """ records statements, inserts return consecutive rowids """
+
+    def __init__(self):
+        self.statements = []
+        self.rowid = 0
+        self.found = ''
+        # statements containing it raise
+        self.fail = None
+
+    def table_id(self, name):
+        return 'areas'
+
+    def sql(self, statement):
+        if self.fail and self.fail in statement:
+            raise Exception('rejected')
+        self.statements.append(statement)
+        if statement.startswith('select'):
+            return 'rowid\n' + self.found
+        return 'rowid\n'
+
+    def sql_batch(self, statements):
+        result = []
+        if self.fail and [s for s in statements if self.fail in s]:
+            raise Exception('rejected')
+        for s in statements:
+            self.statements.append(s)
+            self.rowid += 1
+            result.append('rowid\n%d' % self.rowid)
+        return result
+
+class AreaSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        for x in models.AreaSync.all():
+            x.delete()
+        self.ft = FakeFT()
+        self._get_ft_client = Area._get_ft_client
+        Area._get_ft_client = staticmethod(lambda: self.ft)
+        r = Report(start=date.today(), finished=False)
+        r.put()
+        self.cell = Cell(x=0, y=0, z=2, report=r, ndfi_high=1.0, ndfi_low=0.0)
+        self.cell.put()
+
+    def tearDown(self):
+        Area._get_ft_client = self._get_ft_client
+
+    def new_area(self):
+        area = Area(geo='[[[-61.5,-12],[-61.5,-11],[-60.5,-11],[-60.5,-12]]]', type=1, cell=self.cell)
+        area.save()
+        return area
+
+    def entry(self, area):
+        return models.AreaSync.get_by_key_name('sync', parent=area)
+
+    def sent(self, op):
+        return [s for s in self.ft.statements if s.startswith(op)]
+
+    def test_coalesce(self):
+        area = self.new_area()
+        area.type = 2
+        area.save()
+        e = self.entry(area)
+        self.assertEquals(models.AreaSync.CREATE, e.op)
+        self.assertEquals(2, e.version)
+        models.AreaSync.drain()
+        self.assertEquals(1, len(self.sent('insert')))
+        self.assertEquals(1, Area.get(area.key()).fusion_tables_id)
+        self.assertEquals(None, self.entry(area))
+        area = Area.get(area.key())
+        area.save()
+        self.assertEquals(models.AreaSync.UPDATE, self.entry(area).op)
+        models.AreaSync.drain()
+        self.assertEquals(1, len(self.sent('update  areas')))
+
+    def test_create_delete(self):
+        area = self.new_area()
+        area.delete()
+        self.assertEquals(None, self.entry(area))
+        models.AreaSync.drain()
+        self.assertEquals([], self.ft.statements)
+
+    def test_delete_after_insert(self):
+        # inserted by drain but the entry was not removed yet
+        area = self.new_area()
+        stored = Area.get(area.key())
+        stored.fusion_tables_id = 3
+        db.put(stored)
+        area.delete()
+        e = self.entry(area)
+        self.assertEquals(models.AreaSync.DELETE, e.op)
+        self.assertEquals(3, e.fusion_tables_id)
+        models.AreaSync.drain()
+        self.assertEquals(["delete from areas where rowid = '3'"], self.ft.statements)
+
+    def test_retry_finds_row(self):
+        area = self.new_area()
+        e = self.entry(area)
+        e.attempts = 1
+        e.put()
+        self.ft.found = '7\n'
+        models.AreaSync.drain()
+        self.assertEquals([], self.sent('insert'))
+        self.assertEquals(1, len(self.sent('select')))
+        self.assertEquals(7, Area.get(area.key()).fusion_tables_id)
+        self.assertEquals(None, self.entry(area))
+
+    def test_failed_entry(self):
+        first, second = self.new_area(), self.new_area()
+        models.AreaSync.drain()
+        first, second = Area.get(first.key()), Area.get(second.key())
+        first.save()
+        second.save()
+        self.ft.fail = "rowid = '%s'" % first.fusion_tables_id
+        models.AreaSync.drain()
+        # the other change is sent anyway
+        self.assertEquals(None, self.entry(second))
+        self.assertEquals(1, self.entry(first).failures)
+        for i in xrange(settings.FT_SYNC_MAX_FAILURES - 1):
+            models.AreaSync.drain()
+        self.assertEquals(None, self.entry(first))
+        failed = models.AreaSyncFailure.all().ancestor(first).fetch(2)
+        self.assertEquals([models.AreaSync.UPDATE], [x.op for x in failed])
+
+    def test_failed_insert_alone(self):
+        self.ft.fail = 'insert'
+        area = self.new_area()
+        models.AreaSync.drain()
+        self.assertEquals(1, self.entry(area).failures)
+        self.ft.fail = None
+        other = self.new_area()
+        models.AreaSync.drain()
+        # looked up first since the insert may have been sent
+        self.assertEquals(1, len(self.sent('select')))
+        self.assertEquals(2, len(self.sent('insert')))
+        self.assertEquals(None, self.entry(area))
+        self.assertEquals(None, self.entry(other))
+
+    def test_changed_while_sending(self):
+        area = self.new_area()
+        loaded = self.entry(area)
+        area.save()
+        models.AreaSync._count_attempt(loaded.key())
+        e = self.entry(area)
+        self.assertEquals(2, e.version)
+        self.assertEquals(1, e.attempts)
+        models.AreaSync._done(loaded.key(), loaded.version)
+        self.assertNotEquals(None, self.entry(area))
+        models.AreaSync._done(loaded.key(), e.version)
+        self.assertEquals(None, self.entry(area))
+
 
 
 class CommandTest(unittest.TestCase, GoogleAuthMixin):
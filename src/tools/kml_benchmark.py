@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+compare the old string concatenation KML encoder with application.kml
+on 10k vertex polygons
+
+    python tools/kml_benchmark.py
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'application'))
+from kml import path_to_kml, kml_to_paths
+
+VERTICES = 10000
+RUNS = 20
+
+
+def path_to_kml_concat(paths):
+    """ encoder used before application.kml """
+    kml = "<Polygon>"
+    kml+= "<outerBoundaryIs>"
+    kml+= "<LinearRing>"
+    kml+="<coordinates>"
+    for p in paths[0]:
+        kml+= str(p[1]) + "," + str(p[0]) + ",0\n"
+    kml += "</coordinates>"
+    kml+= "</LinearRing>"
+    kml+= "</outerBoundaryIs>"
+    for inner in paths[1:]:
+        kml +="<innerBoundaryIs>"
+        kml+= "<LinearRing>"
+        kml+="<coordinates>"
+        for p in inner:
+            kml+= str(p[1]) + "," + str(p[0]) + ",0\n"
+        kml += "</coordinates>"
+        kml+= "</LinearRing>"
+        kml +="</innerBoundaryIs>"
+    kml += "</Polygon>"
+    return kml;
+
+
+def random_paths(vertices):
+    outer = [(random.uniform(-18, 5), random.uniform(-74, -43)) for _ in xrange(vertices)]
+    inner = [(random.uniform(-18, 5), random.uniform(-74, -43)) for _ in xrange(vertices/10)]
+    return [outer, inner]
+
+
+def bench(name, fn):
+    t = min(timeit.repeat(fn, number=RUNS, repeat=3))/RUNS
+    print "%-30s %8.2f ms" % (name, t*1000)
+
+
+if __name__ == '__main__':
+    paths = random_paths(VERTICES)
+    assert path_to_kml(paths) == path_to_kml_concat(paths)
+    kml = path_to_kml(paths)
+    print "%d vertices, %d bytes (%d bytes with precision 6)" % (
+        VERTICES*11/10, len(kml), len(path_to_kml(paths, 6)))
+    bench("concatenation", lambda: path_to_kml_concat(paths))
+    bench("path_to_kml", lambda: path_to_kml(paths))
+    bench("path_to_kml precision=6", lambda: path_to_kml(paths, 6))
+    bench("kml_to_paths", lambda: kml_to_paths(kml))